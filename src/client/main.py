@@ -1,7 +1,6 @@
 """The entry point for the client-side application."""
 
 import asyncio
-import json
 from time import time
 from typing import Sequence
 
@@ -31,6 +30,7 @@ lbl_player_sign = Label(
 )
 btn_join_room = Button("Join room", (0.5, 11 / 28), disabled=True, menu=Menu.settings)
 btn_create_room = Button("Create room", (0.5, 17 / 28), menu=Menu.settings)
+btn_quick_match = Button("Quick match", (0.5, 23 / 28), menu=Menu.settings)
 btn_retry_connection = Button("Retry connnection", (0.5, 9 / 14))
 btn_disconnect = Button("Disconnect", (0.5, 13 / 14), menu=Menu.game)
 lbl_current_info = Label("Connecting to server...", (0.5, 0.5))
@@ -71,6 +71,19 @@ def create_room():
     backend.session.send_message({"type": "create_room"})
 
 
+@btn_quick_match.on_mouse("up")
+def quick_match():
+    """
+    Asks for a quick match.
+
+    The server puts the client in a room with the next player that asks for one,
+    or with the player that has been waiting the longest.
+    """
+    backend.session.send_message({"type": "quick_match"})
+    lbl_current_info.label = "Looking for an opponent..."
+    GameInfo.current_stage = GameStage.LOADING
+
+
 @btn_disconnect.on_mouse("down")
 def disconnect_from_room():
     """Disconnects from room."""
@@ -81,23 +94,15 @@ def disconnect_from_room():
         btn_join_room.toggle_disabled_state()
     GameInfo.connected_room = None
     GameInfo.player_sign = None
+    backend.session.session_token = None
 
 
 # ENDREGION
 
 # REGION Register websocket events
 @backend.session.on_server_message
-def on_server_message(data: str | bytes) -> None:
+def on_server_message(data: dict) -> None:
     """Handler for incoming server messages."""
-    if isinstance(data, bytes):
-        data: str = bytes.decode()
-    try:
-        parsed = json.loads(data)
-    except (TypeError, json.decoder.JSONDecodeError):
-        debug("Invalid server message:", data)
-        return
-    else:
-        data: dict = parsed
     data_type = data.get("type")
     if data_type != "log":
         debug(f"CLIENT: Received message '{data}'")
@@ -110,16 +115,68 @@ def on_server_message(data: str | bytes) -> None:
             GameInfo.player_sign = sign
             lbl_player_sign.label = f"You are player: {sign}"
             GameInfo.connected_room = room_id
+            GameInfo.board_seq = None
+            backend.session.session_token = data.get("session")
             if btn_disconnect.disabled:
                 btn_disconnect.toggle_disabled_state()
             grid.reset()
+        case "resume":
+            # Back in the room after the connection was lost, the game state follows
+            lbl_room_info.label = f"Connected to room #{data.get('room_id')}"
+            GameInfo.connected_room = data.get("room_id")
+            GameInfo.player_sign = data.get("sign")
+            GameInfo.board_seq = None
+            backend.session.session_token = data.get("session")
+        case "resume_error":
+            # The seat was given away, so go back to the lobby
+            debug(f"Could not resume the game: {data.get('message')}")
+            backend.session.session_token = None
+            GameInfo.connected_room = None
+            GameInfo.player_sign = None
+            GameInfo.current_stage = GameStage.JOIN_ROOM
+            backend.session.send_message({"type": "get_open_rooms"})
+        case "game_state":
+            GameInfo.board = data.get("board")
+            GameInfo.board_seq = data.get("seq")
+            for row_i, row in enumerate(GameInfo.board):
+                for col_i, col in enumerate(row):
+                    grid.child_cells[row_i * 3 + col_i].label = col
+            x_wins, o_wins = data.get("x_wins"), data.get("o_wins")
+            wins, losses = (
+                (x_wins, o_wins) if GameInfo.player_sign == "x" else (o_wins, x_wins)
+            )
+            lbl_game_status.label = f"{wins} - {losses}"
+            # Continue the countdown of the round where it is, the grid is enabled once it ends
+            GameInfo.current_round = data.get("round")
+            GameInfo.game_started = False
+            GameInfo.countdown_started = time() - (3 - data.get("countdown"))
+            if not grid.disabled:
+                grid.toggle_disabled_state()
+            GameInfo.current_stage = GameStage.GAME_IN_PROGRESS
         case "update_board":
+            # Full board, sent at the start of every round or after a missed cell update
             GameInfo.board = data.get("board")
+            GameInfo.board_seq = data.get("seq")
             for row_i, row in enumerate(GameInfo.board):
                 for col_i, col in enumerate(row):
-                    if col == "*":
-                        continue
                     grid.child_cells[row_i * 3 + col_i].label = col
+        case "cell_set":
+            seq = data.get("seq")
+            if GameInfo.board_seq is None or seq <= GameInfo.board_seq:
+                # Waiting for the full board, or the change is already included in it
+                return
+            if seq != GameInfo.board_seq + 1:
+                # Missed at least one cell update, so request the full board again
+                debug(f"Board sequence gap ({GameInfo.board_seq} -> {seq})")
+                GameInfo.board_seq = None
+                backend.session.send_message(
+                    {"type": "get_board", "room_id": GameInfo.connected_room}
+                )
+                return
+            GameInfo.board_seq = seq
+            cell, sign = data.get("cell"), data.get("sign")
+            GameInfo.board[cell // 3][cell % 3] = sign
+            grid.child_cells[cell].label = sign
 
         case "leave_room":
             pass
@@ -130,22 +187,51 @@ def on_server_message(data: str | bytes) -> None:
             GameInfo.game_started = False
             GameInfo.countdown_started = time()
             GameInfo.current_stage = GameStage.GAME_IN_PROGRESS
+        case "quick_match":
+            # No other player is waiting, so wait in the queue until one asks for a match
+            GameInfo.current_stage = GameStage.WAITING_FOR_PLAYER
+            lbl_player_sign.label = "Quick match"
+            if btn_disconnect.disabled:
+                btn_disconnect.toggle_disabled_state()
         case "join_room_error":
             GameInfo.current_stage = GameStage.JOIN_ROOM
+        case "join_room_redirect":
+            # The room is owned by another server shard, so join it there
+            backend.session.redirect(
+                data.get("url"), {"type": "join_room", "room_id": data.get("room_id")}
+            )
+        case "player_reconnecting":
+            lbl_countdown.assert_properties(
+                label="Opponent is reconnecting...", font_colour=Colour.YELLOW
+            )
+        case "player_reconnected":
+            lbl_countdown.assert_properties(
+                label="Opponent is back!", font_colour=Colour.WHITE
+            )
         case "player_disconnected":
             grid.reset()
             GameInfo.current_stage = GameStage.WAITING_FOR_PLAYER
         case "update_open_rooms":
-            open_rooms = data.get("open_rooms")
-            options = tuple((room, f"Room {room}") for room in open_rooms)
+            # Full snapshot of the lobby
+            GameInfo.lobby_version = data.get("version")
+            options = tuple(get_room_option(room) for room in data.get("open_rooms"))
             dropdown_room.set_options(options)
-            if len(open_rooms) == 0 and not btn_join_room.disabled:
-                btn_join_room.toggle_disabled_state()
-            if GameInfo.current_stage == GameStage.JOIN_ROOM:
-                lbl_room_info.label = f"Open rooms: {len(open_rooms)}"
-            # This seems not to work as intended
-            # if btn_join_room.disabled == (len(open_rooms) > 0):
-            #     btn_join_room.toggle_disabled_state()
+            update_open_rooms_info()
+        case "update_open_rooms_delta":
+            version = data.get("version")
+            if GameInfo.lobby_version is None or version <= GameInfo.lobby_version:
+                # Waiting for a snapshot, or the delta is already included in the last one
+                return
+            if version != GameInfo.lobby_version + 1:
+                # Missed at least one delta, so request the full list of rooms again
+                debug(f"Lobby version gap ({GameInfo.lobby_version} -> {version})")
+                GameInfo.lobby_version = None
+                backend.session.send_message({"type": "get_open_rooms"})
+                return
+            GameInfo.lobby_version = version
+            added = tuple(get_room_option(room) for room in data.get("rooms_added"))
+            dropdown_room.apply_delta(added, data.get("rooms_removed"))
+            update_open_rooms_info()
         case "win_round":
             grid.toggle_disabled_state()
             winner = data.get("sign")
@@ -169,6 +255,11 @@ def on_server_message(data: str | bytes) -> None:
             )
             lbl_countdown.assert_properties(label=message, font_colour=colour)
             grid.toggle_disabled_state()
+        case "rate_limited":
+            debug(f"Sending {data.get('message_type')} messages too fast")
+        case "heartbeat":
+            # Let the server know that the connection is still alive
+            backend.session.send_message({"type": "heartbeat"})
         case "playercount":
             GameInfo.playercount = data.get("playercount")
         case "log":
@@ -177,6 +268,23 @@ def on_server_message(data: str | bytes) -> None:
             debug("Received unknown server message:", data)
 
 
+def get_room_option(room_id: int) -> tuple[int, str]:
+    """Gets the dropdown option for the open room."""
+    return room_id, f"Room {room_id}"
+
+
+def update_open_rooms_info() -> None:
+    """Updates the gui to reflect the current number of open rooms."""
+    num_open_rooms = len(dropdown_room.options)
+    if num_open_rooms == 0 and not btn_join_room.disabled:
+        btn_join_room.toggle_disabled_state()
+    if GameInfo.current_stage == GameStage.JOIN_ROOM:
+        lbl_room_info.label = f"Open rooms: {num_open_rooms}"
+    # This seems not to work as intended
+    # if btn_join_room.disabled == (num_open_rooms > 0):
+    #     btn_join_room.toggle_disabled_state()
+
+
 @btn_retry_connection.on_mouse("down")
 def connect_to_server() -> None:
     """Instructs the program to start a thread to create the websocket connection."""
@@ -100,6 +100,8 @@ class GameInfo:
     countdown_started: float = -1
     current_round: int = 0
     board: list[list[str]] = None
+    board_seq: int | None = None
+    lobby_version: int | None = None
 
 
 class Message(str):
@@ -2,13 +2,13 @@
 
 # Built-in library imports
 import asyncio
-import json
 import threading
 from time import time
 from typing import Callable, Coroutine, Literal
 
 # Local application imports
 from modules import FRAMERATE, GameInfo, GameStage, Message
+from modules.codec import CODECS, DEFAULT_CODEC, PREFERRED_CODECS
 from modules.util import debug
 from websockets import client as ws_client
 from websockets import exceptions as ws_exceptions
@@ -17,11 +17,17 @@ from websockets import exceptions as ws_exceptions
 # game process functions in the space of one game tick
 MESSAGE_TIMEOUT = 1 / FRAMERATE / 2
 
+# Seconds between the attempts to reconnect to the server after the connection was lost
+# during a game, and the number of attempts made before giving up. The server keeps
+# the seat of the client for 30 seconds by default.
+RECONNECT_DELAY = 2.0
+RECONNECT_ATTEMPTS = 12
+
 
 async def send_json(websocket: ws_client.WebSocketClientProtocol, data: dict):
-    """Stringifies the JSON data and sends it to the server."""
-    stringified = json.dumps(data)
-    await websocket.send(stringified)
+    """Encodes the JSON data with the negotiated codec and sends it to the server."""
+    encoded = session.codec.encode(data)
+    await websocket.send(encoded)
     debug(f"CLIENT: Sent message '{data}'")
 
 
@@ -30,15 +36,25 @@ class WebSocket:
 
     def __init__(self):
         self._data_to_send: list[dict] = []
-        self._message_handler: Callable[[str | bytes], None] = None
+        self._message_handler: Callable[[dict], None] = None
         self.on_handshake: Callable[..., None] | None = None
         self.connected: bool = False
+        self.codec = DEFAULT_CODEC
+        self.redirect_url: str | None = None
+        # Token of the client's seat, used to resume the game if the connection is lost
+        self.session_token: str | None = None
+        self.resuming: bool = False
         super().__init__()
 
     def send_message(self, message: dict | Literal["PING"]) -> None:
         """Sends the message object to the server through the active websocket connection."""
         self._data_to_send.append(message)
 
+    def redirect(self, url: str, message: dict) -> None:
+        """Reconnects to the server shard at the given URL and sends it the message once connected."""
+        self.redirect_url = url
+        self._data_to_send.insert(0, message)
+
     async def send_all_data(self, websocket: ws_client.WebSocketClientProtocol) -> None:
         """Sends all the data in the message stack."""
         while self._data_to_send:
@@ -52,7 +68,7 @@ class WebSocket:
             await (await websocket.ping())
             GameInfo.ping = round((time() - start_time) * 1000)  # Convert diff to ms
 
-    def on_server_message(self, handler: Callable[[str | bytes], None]) -> None:
+    def on_server_message(self, handler: Callable[[dict], None]) -> None:
         """Used to decorate functions that will handle all server messages."""
         self._message_handler = handler
 
@@ -61,7 +77,12 @@ class WebSocket:
         if self._message_handler is None:
             print("ERROR: No server message handler set.")
             return
-        coro = self._message_handler(data)
+        try:
+            message = self.codec.decode(data)
+        except (TypeError, ValueError):
+            debug("Invalid server message:", data)
+            return
+        coro = self._message_handler(message)
         if isinstance(coro, Coroutine):
             await coro
 
@@ -85,10 +106,19 @@ def get_url(url: str, path: str, scheme: str = "ws") -> str:
     return url
 
 
-async def _on_websocket_handshake(websocket: ws_client.WebSocketClientProtocol) -> None:
+async def _on_websocket_handshake(
+    websocket: ws_client.WebSocketClientProtocol, redirected: bool
+) -> None:
     """Called when the websocket connection is established."""
     session.connected = True
-    GameInfo.current_stage = GameStage.JOIN_ROOM
+    if session.resuming:
+        # Take the seat back, the server then sends the state of the game
+        session.resuming = False
+        await send_json(websocket, {"type": "resume", "session": session.session_token})
+        return
+    if not redirected:
+        GameInfo.current_stage = GameStage.JOIN_ROOM
+    GameInfo.lobby_version = None
     await asyncio.gather(
         send_json(websocket, {"type": "get_open_rooms"}),
         # send_json(websocket, {"type": "get_playercount"}),
@@ -107,13 +137,59 @@ def _on_websocket_error(connection_dropped: bool):
 
 
 async def make_websocket_connection(url: str):
-    """Makes a blocking infinite connection to the server websocket."""
-    url = get_url(url, "ws")
-
+    """
+    Makes a blocking infinite connection to the server websocket.
+
+    Redirects to other shards are followed, and if the connection is lost while
+    the client has a seat in a room, it reconnects and resumes the game.
+    """
+    redirected = False
+    attempts = 0
+    while url is not None:
+        connected, connection_dropped = await _run_websocket_connection(
+            get_url(url, "ws"), redirected
+        )
+        if connected:
+            attempts = 0
+        if session.redirect_url is not None:
+            url, session.redirect_url = session.redirect_url, None
+            redirected = True
+        elif connection_dropped is None:
+            # The game was aborted
+            url = None
+        elif session.session_token is not None and attempts < RECONNECT_ATTEMPTS:
+            debug("Connection lost, reconnecting to resume the game...")
+            session.connected = False
+            attempts += 1
+            session.resuming = True
+            redirected = True
+            await asyncio.sleep(RECONNECT_DELAY)
+        else:
+            _on_websocket_error(connection_dropped or attempts > 0)
+            url = None
+
+
+async def _run_websocket_connection(
+    url: str, redirected: bool
+) -> tuple[bool, bool | None]:
+    """
+    Keeps the websocket connection open until the game is aborted or the server redirects the client.
+
+    Returns whether the connection was established, and whether it was dropped (None if it was not lost).
+    """
+    connected = False
     try:
-        async with ws_client.connect(url) as websocket:
-            await _on_websocket_handshake(websocket)
-            while GameInfo.current_stage != GameStage.ABORTED:
+        async with ws_client.connect(
+            url, subprotocols=PREFERRED_CODECS or None
+        ) as websocket:
+            # Fall back to plain JSON if the server did not accept any of the codecs
+            session.codec = CODECS.get(websocket.subprotocol, DEFAULT_CODEC)
+            connected = True
+            await _on_websocket_handshake(websocket, redirected)
+            while (
+                GameInfo.current_stage != GameStage.ABORTED
+                and session.redirect_url is None
+            ):
                 # print(f"{len(session._data_to_send)} messages to send")
                 await session.send_all_data(websocket)
                 try:
@@ -124,15 +200,16 @@ async def make_websocket_connection(url: str):
                 else:
                     # Handle the received message
                     await session.receive_message(data)
-    except ConnectionRefusedError:
-        # Could not connect
-        _on_websocket_error(False)
+    except OSError:
+        # Could not connect, or the network failed while connected
+        return connected, connected
     except (
         ws_exceptions.ConnectionClosedError,
         ws_exceptions.ConnectionClosedOK,
     ):
         # Connection was terminated
-        _on_websocket_error(True)
+        return connected, True
+    return connected, None
 
 
 def connect_to_websocket(url: str, callback: Callable[..., None]):
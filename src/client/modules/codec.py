@@ -0,0 +1,70 @@
+"""Module containing the codecs used to encode and decode websocket messages. Mirrors `server/codec.py`."""
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class JsonCodec:
+    """Plain JSON sent in text frames. Supported by every client."""
+
+    name = "json"
+    binary = False
+
+    def encode(self, message: dict) -> str:
+        """Encodes the message."""
+        return json.dumps(message, separators=(",", ":"))
+
+    def decode(self, data: str | bytes) -> dict:
+        """Decodes the message."""
+        return json.loads(data)
+
+
+class OrjsonCodec(JsonCodec):
+    """JSON encoded with orjson, still sent in text frames."""
+
+    name = "orjson"
+
+    def encode(self, message: dict) -> str:
+        """Encodes the message."""
+        return orjson.dumps(message).decode()
+
+    def decode(self, data: str | bytes) -> dict:
+        """Decodes the message."""
+        return orjson.loads(data)
+
+
+class MsgpackCodec:
+    """MessagePack sent in binary frames."""
+
+    name = "msgpack"
+    binary = True
+
+    def encode(self, message: dict) -> bytes:
+        """Encodes the message."""
+        return msgpack.packb(message)
+
+    def decode(self, data: str | bytes) -> dict:
+        """Decodes the message."""
+        return msgpack.unpackb(data)
+
+
+DEFAULT_CODEC = JsonCodec()
+
+# All codecs whose libraries are installed, by name.
+CODECS = {DEFAULT_CODEC.name: DEFAULT_CODEC}
+if orjson is not None:
+    CODECS[OrjsonCodec.name] = OrjsonCodec()
+if msgpack is not None:
+    CODECS[MsgpackCodec.name] = MsgpackCodec()
+
+# Codecs to request from the server, in order of preference. Plain JSON is always the fallback.
+PREFERRED_CODECS = [name for name in ("msgpack", "orjson") if name in CODECS]
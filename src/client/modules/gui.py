@@ -560,13 +560,24 @@ class Dropdown(SelectableElement):
         # Toggle the disabled state if it is incorrect
         if (len(options) > 0) == self.disabled:
             self.toggle_disabled_state()
-        if self.selected_option not in options:
+        if self.selected_option not in (key for key, _ in options):
+            self.selected_option = None
             self.label = self.placeholder_label
         self.options = tuple(options)
         self.option_elems = [
             self._create_option(*option) for option in enumerate(self.options)
         ]
 
+    def apply_delta(
+        self, added: Sequence[tuple[int, str]], removed: Sequence[int]
+    ) -> None:
+        """Adds and removes options without replacing the ones that did not change."""
+        removed = set(removed)
+        existing = {key for key, _ in self.options}
+        options = [option for option in self.options if option[0] not in removed]
+        options += [option for option in added if option[0] not in existing]
+        self.set_options(options)
+
     def on_selection_change(
         self, callback: Callable[[], Coroutine | None]
     ) -> Callable[[], Coroutine | None]:
@@ -587,7 +598,7 @@ class Grid(BaseElement):
 
     def reset(self):
         """Called whenever the board has to be cleared."""
-        GameInfo.board = [["*"] * 3] * 3
+        GameInfo.board = [["*"] * 3 for _ in range(3)]
         self.child_cells = list(self._create_cell_elements())
 
     def draw(self, screen: pygame.Surface) -> None:
@@ -0,0 +1,70 @@
+"""This file contains the allocator of room IDs."""
+
+from collections import deque
+from secrets import randbits
+from time import monotonic
+from typing import Callable
+
+# Number of bits of the room numbers, which limits the number of rooms that can ever be created.
+ROOM_ID_BITS = 32
+
+# Time in seconds before the ID of a deleted room can be given to a new room.
+ROOM_ID_QUARANTINE = 300.0
+
+# Number of rounds of the permutation that scrambles the room numbers.
+PERMUTATION_ROUNDS = 4
+
+
+class RoomIdAllocator:
+    """
+    This class gives every new room a unique ID in constant time.
+
+    New IDs are a counter passed through a keyed permutation (a Feistel network), so they never
+    collide but cannot be guessed from each other. IDs of deleted rooms are given out again,
+    but only after the quarantine, so that clients still holding the old ID do not end up
+    joining a different room.
+    """
+
+    def __init__(
+        self,
+        make_room_id: Callable[[int], int] = int,
+        bits: int = ROOM_ID_BITS,
+        quarantine: float = ROOM_ID_QUARANTINE,
+    ):
+        # Function that turns a room number into the room ID, e.g. to encode the shard in it.
+        self.make_room_id = make_room_id
+
+        self.half_bits = bits // 2
+        self.half_mask = (1 << self.half_bits) - 1
+        self.keys = [randbits(self.half_bits) for _ in range(PERMUTATION_ROUNDS)]
+
+        self.counter = 0
+        self.limit = 1 << (2 * self.half_bits)
+
+        # IDs of deleted rooms with the time they can be given out again, oldest first.
+        self.quarantine = quarantine
+        self.released = deque()
+
+    def permute(self, number: int) -> int:
+        """This function maps the number to another number of the same size, different for every number."""
+        left, right = number >> self.half_bits, number & self.half_mask
+        for key in self.keys:
+            mixed = ((right ^ key) * 0x9E3779B1) >> 7
+            left, right = right, left ^ (mixed & self.half_mask)
+        return (left << self.half_bits) | right
+
+    def allocate(self) -> int:
+        """Gets an ID that is not used by any room."""
+        if self.released and self.released[0][0] <= monotonic():
+            return self.released.popleft()[1]
+
+        if self.counter == self.limit:
+            raise RuntimeError("All room IDs are in use.")
+
+        number = self.permute(self.counter)
+        self.counter += 1
+        return self.make_room_id(number)
+
+    def release(self, room_id: int):
+        """Gives the ID of a deleted room back, to be reused once the quarantine has passed."""
+        self.released.append((monotonic() + self.quarantine, room_id))
@@ -0,0 +1,111 @@
+"""This file contains the codecs used to encode and decode websocket messages."""
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from fastapi import WebSocket
+
+
+class JsonCodec:
+    """Plain JSON sent in text frames. Supported by every client."""
+
+    name = "json"
+    binary = False
+
+    def encode(self, message: dict) -> str:
+        """Encodes the message."""
+        return json.dumps(message, separators=(",", ":"))
+
+    def decode(self, data: str | bytes) -> dict:
+        """Decodes the message."""
+        return json.loads(data)
+
+
+class OrjsonCodec(JsonCodec):
+    """JSON encoded with orjson, still sent in text frames."""
+
+    name = "orjson"
+
+    def encode(self, message: dict) -> str:
+        """Encodes the message."""
+        return orjson.dumps(message).decode()
+
+    def decode(self, data: str | bytes) -> dict:
+        """Decodes the message."""
+        return orjson.loads(data)
+
+
+class MsgpackCodec:
+    """MessagePack sent in binary frames."""
+
+    name = "msgpack"
+    binary = True
+
+    def encode(self, message: dict) -> bytes:
+        """Encodes the message."""
+        return msgpack.packb(message)
+
+    def decode(self, data: str | bytes) -> dict:
+        """Decodes the message."""
+        return msgpack.unpackb(data)
+
+
+class SharedMessage:
+    """
+    Message sent to many clients, which is encoded at most once per codec.
+
+    The same instance is queued in the outboxes of all its recipients,
+    so the first one to send it encodes it for all others using its codec.
+    """
+
+    __slots__ = ("message", "encoded")
+
+    def __init__(self, message: dict):
+        self.message = message
+        self.encoded = {}
+
+    def encode(self, codec) -> str | bytes:
+        """Gets the message encoded with the codec."""
+        data = self.encoded.get(codec.name)
+        if data is None:
+            data = self.encoded[codec.name] = codec.encode(self.message)
+        return data
+
+
+DEFAULT_CODEC = JsonCodec()
+
+# All codecs whose libraries are installed, by name.
+CODECS = {DEFAULT_CODEC.name: DEFAULT_CODEC}
+if orjson is not None:
+    CODECS[OrjsonCodec.name] = OrjsonCodec()
+if msgpack is not None:
+    CODECS[MsgpackCodec.name] = MsgpackCodec()
+
+
+def negotiate_codec(client: WebSocket):
+    """
+    Chooses the codec for the client.
+
+    The client can request a codec with the `codec` query parameter, or with
+    the websocket subprotocols, in which case the first supported one is used.
+    Returns the codec and the subprotocol that has to be accepted, if any.
+    Clients that do not request a supported codec (e.g. the browser client) use plain JSON.
+    """
+    requested = client.query_params.get("codec")
+    if requested in CODECS:
+        return CODECS[requested], None
+
+    for subprotocol in client.scope.get("subprotocols", []):
+        if subprotocol in CODECS:
+            return CODECS[subprotocol], subprotocol
+
+    return DEFAULT_CODEC, None
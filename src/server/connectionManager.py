@@ -1,29 +1,204 @@
-from random import randint
+import asyncio
+import logging
+import re
+from itertools import count
+from secrets import token_urlsafe
+from time import monotonic, perf_counter
+from uuid import uuid4
 
-from fastapi import WebSocket
+from fastapi import WebSocket, WebSocketDisconnect
+
+from server.allocator import RoomIdAllocator
+from server.codec import SharedMessage, negotiate_codec
+from server.outbox import GAME_PRIORITY, LOBBY_PRIORITY, Outbox
+from server.registry import (
+    LOBBY_CHANNEL, InMemoryRegistry, Registry, worker_channel
+)
+from server.tracing import LOBBY_TID, tracer
+
+logger = logging.getLogger(__name__)
+
+# Default time in seconds during which lobby changes are collected into a single update.
+LOBBY_FLUSH_INTERVAL = 0.05
+
+# Default time in seconds between heartbeats, and number of heartbeats that a client
+# can miss (i.e. not send any message for) before it is disconnected.
+HEARTBEAT_INTERVAL = 10.0
+HEARTBEAT_MISSES = 3
+
+# Default time in seconds during which a player whose connection was lost keeps its seat
+# and can resume the game with its session token.
+SESSION_GRACE = 30.0
+
+# Player IDs that clients can connect with, which the results of their games are recorded under.
+PLAYER_ID_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,64}")
 
 
 class ConnectionManager:
     """This class handles connection to the rooms."""
 
-    def __init__(self):
+    def __init__(
+        self,
+        lobby_flush_interval: float = LOBBY_FLUSH_INTERVAL,
+        registry: Registry | None = None,
+        heartbeat_interval: float = HEARTBEAT_INTERVAL,
+        heartbeat_misses: int = HEARTBEAT_MISSES,
+        session_grace: float = SESSION_GRACE,
+    ):
         """This function sets variables of ConnectionManager object to default values."""
-        # List of all existing rooms.
-        self.rooms = {}
+        # Registry holding the rooms of all workers.
+        if registry is None:
+            registry = InMemoryRegistry()
+        self.registry = registry
+
+        # Allocator of the IDs of the rooms created by this worker.
+        self.room_ids = RoomIdAllocator(registry.make_room_id)
+
+        # ID of this worker, used to route messages to its connections and rooms.
+        self.worker_id = uuid4().hex
+
+        # Connection ID of every connected client, and the client of every connection ID.
+        self.conn_ids = {}
+        self.connections = {}
+        self.conn_counter = count()
+
+        # Player ID of every connection whose client gave a valid `player` query parameter.
+        # The results of the other clients are not recorded.
+        self.player_ids = {}
+
+        # Function that runs the game events of the rooms owned by this worker.
+        self.game_event_handler = None
 
         # List of all clients that are not connected to room.
         self.open_clients = []
 
+        # Room ID, sign and owner worker of every client that is connected to a room.
+        self.client_rooms = {}
+
+        # Clients waiting for a quick match, in the order they asked for it.
+        # A dict is used as an insertion-ordered set, so that clients can leave the queue in constant time.
+        self.match_queue = {}
+
+        # Room ID and owner worker of every client that is spectating a room.
+        self.spectating = {}
+
+        # IDs of all rooms that have only one connected player, in the order they were opened.
+        # A dict is used as an insertion-ordered set. This is a copy of the registry's open rooms,
+        # kept up to date by the changes published on the lobby channel.
+        self.open_rooms = {}
+
+        # Version of the lobby, increased every time a delta is sent to the open clients.
+        self.lobby_version = 0
+
+        # Message with all open rooms as of its lobby version, built once per version.
+        self.lobby_snapshot = None
+
+        # Changes to the open rooms that have not been sent to the open clients yet.
+        self.rooms_added = {}
+        self.rooms_removed = {}
+
+        # Task that sends the collected lobby changes once the flush interval has passed.
+        self.lobby_flush_interval = lobby_flush_interval
+        self.lobby_flush_task = None
+
+        # Number of lobby change notifications and of updates that were actually sent for them.
+        self.lobby_stats = {
+            "notifications": 0,
+            "flushes": 0,
+        }
+
+        # Outbox of every connected client.
+        self.outboxes = {}
+
+        # Outcomes of all messages sent to the clients.
+        self.send_stats = {
+            "sent": 0,
+            "timed_out": 0,
+            "failed": 0,
+            "dropped": 0,
+        }
+
+        # Time at which every client last sent a message. A single task sends the heartbeats
+        # to all clients and disconnects the ones that stopped answering them.
+        self.last_seen = {}
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_misses = heartbeat_misses
+        self.heartbeat_task = None
+
+        # Session token of every client that has a seat in a room, and the client of every token.
+        # Lost connections keep their seat in a game in progress during the grace window, in which
+        # the token can be used to resume the game. The parked seats are stored by token, as
+        # (connection ID, room ID, sign, owner worker) tuples, along with the tasks that free them
+        # once the grace window has passed and the token of every parked connection ID.
+        self.session_tokens = {}
+        self.sessions = {}
+        self.session_grace = session_grace
+        self.parked_seats = {}
+        self.expiry_tasks = {}
+        self.parked_tokens = {}
+
+    async def start(self):
+        """This function connects to the registry and subscribes to the lobby changes and to this worker's messages."""
+        await self.registry.connect()
+        await self.registry.subscribe(LOBBY_CHANNEL, self.on_lobby_change)
+        await self.registry.subscribe(
+            worker_channel(self.worker_id), self.on_worker_message
+        )
+
+        await self.sync_open_rooms()
+        self.registry.resync_handler = self.sync_open_rooms
+
+        if self.heartbeat_interval > 0:
+            self.heartbeat_task = asyncio.create_task(self.run_heartbeat())
+
+    async def stop(self):
+        """This function stops the heartbeats and closes the connection to the registry."""
+        if self.heartbeat_task is not None:
+            self.heartbeat_task.cancel()
+        for task in self.expiry_tasks.values():
+            task.cancel()
+
+        await self.registry.close()
+
     async def connect(self, client: WebSocket):
         """This function accepts websocket connection and adds connected client to list of open clients."""
-        print("conn_manager.connect:")
+        codec, subprotocol = negotiate_codec(client)
+        await client.accept(subprotocol=subprotocol)
+
+        conn_id = f"{self.worker_id}/{next(self.conn_counter)}"
+        self.conn_ids[client] = conn_id
+        self.connections[conn_id] = client
 
-        await client.accept()
+        player_id = client.query_params.get("player")
+        if player_id is not None and PLAYER_ID_PATTERN.fullmatch(player_id):
+            self.player_ids[conn_id] = player_id
 
+        self.outboxes[client] = Outbox(client, self.send_stats, codec, conn_id)
         self.open_clients.append(client)
+        self.last_seen[client] = monotonic()
+
+        logger.info("Client %s connected using codec %s", conn_id, codec.name)
+        logger.debug("%d open clients", len(self.open_clients))
+
+    async def receive(self, client: WebSocket) -> str | bytes:
+        """This function waits for the next message from the client and returns its data."""
+        message = await client.receive()
 
-        print(f"    Client {client} added to open_clients")
-        print(f"    open_clients: {self.open_clients}")
+        # Clients that were disconnected for missing heartbeats are ignored.
+        if message["type"] == "websocket.disconnect" or client not in self.outboxes:
+            raise WebSocketDisconnect(message.get("code", 1000))
+
+        self.last_seen[client] = monotonic()
+
+        data = message.get("text")
+        if data is None:
+            data = message["bytes"]
+
+        return data
+
+    def decode(self, client: WebSocket, data: str | bytes) -> dict:
+        """This function decodes the message data with the client's codec."""
+        return self.outboxes[client].codec.decode(data)
 
     async def create_room(self, client: WebSocket):
         """
@@ -32,168 +207,885 @@ class ConnectionManager:
         This function creates room with one connected player and
         sends message with type "connected" to client that created it.
         """
-        # Create room with one player.
-        room_id = randint(0, 10**5)
-        self.rooms[room_id] = {
-            "x": client,
-            "o": None,
-        }
+        if client in self.client_rooms:
+            self.send(
+                client,
+                {
+                    "type": "create_room_error",
+                    "message": "Leave the room before creating another one.",
+                },
+            )
+            return
+
+        self.match_queue.pop(client, None)
+        self.stop_spectating(client)
+
+        # Create room with one player. IDs only collide with rooms created by other workers.
+        room_id = self.room_ids.allocate()
+        while not await self.registry.create_room(
+            room_id, self.worker_id, self.conn_ids[client]
+        ):
+            room_id = self.room_ids.allocate()
+
+        self.client_rooms[client] = (room_id, "x", self.worker_id)
+        self.leave_lobby(client)
+        self.registry.publish(LOBBY_CHANNEL, {"added": [room_id]})
 
         # Send message to client.
-        await client.send_json(
+        self.send(
+            client,
             {
                 "type": "create_room",
                 "room_id": room_id,
                 "sign": "x",
-            }
+                "session": self.open_session(client),
+            },
         )
 
     async def join_room(self, client: WebSocket, room_id: int):
         """
         Joins the websocket into a room
 
-        This function connects client to room and removes it from list of open clients.
-        Then, starts game and sends message with type "update_open_rooms" to all open clients.
+        This function connects client to room and returns connection IDs of both players.
+        The room is removed from the open rooms once it is full.
+        Clients joining a room of another shard are sent to that shard instead.
         """
-        if room_id not in self.rooms.keys():
-            await client.send_json(
+        if client in self.client_rooms:
+            self.send(
+                client,
                 {
                     "type": "join_room_error",
-                    "message": f"Room {room_id} does not exist.",
-                }
+                    "message": "Leave the room before joining another one.",
+                },
+            )
+            return (None, None)
+
+        self.match_queue.pop(client, None)
+        self.stop_spectating(client)
+
+        shard_url = self.registry.get_room_shard_url(room_id)
+        if shard_url is not None:
+            self.send(
+                client,
+                {
+                    "type": "join_room_redirect",
+                    "room_id": room_id,
+                    "url": shard_url,
+                },
             )
             return (None, None)
 
-        room = self.rooms[room_id]
+        sign, room = await self.registry.join_room(room_id, self.conn_ids[client])
 
-        if None not in [room["x"], room["o"]]:
-            await client.send_json(
+        if room is None:
+            self.send(
+                client,
                 {
                     "type": "join_room_error",
-                    "message": f"Room {room_id} is full.",
-                }
+                    "message": f"Room {room_id} does not exist.",
+                },
             )
             return (None, None)
 
-        # Connect client to the room.
-        if room["x"]:
-            sign = "o"
-        else:
-            sign = "x"
+        if sign is None:
+            self.send(
+                client,
+                {
+                    "type": "join_room_error",
+                    "message": f"Room {room_id} is full.",
+                },
+            )
+            return (None, None)
 
-        room[sign] = client
+        self.client_rooms[client] = (room_id, sign, room["owner"])
+        self.leave_lobby(client)
+        if room["x"] is not None and room["o"] is not None:
+            self.registry.publish(LOBBY_CHANNEL, {"removed": [room_id]})
 
         # Send message to connected client.
-        await client.send_json(
+        self.send(
+            client,
             {
                 "type": "join_room",
                 "room_id": room_id,
                 "sign": sign,
-            }
+                "session": self.open_session(client),
+            },
         )
 
         return (room["x"], room["o"])
 
-    async def disconnect(self, client: WebSocket):
-        """Disconnects the websocket"""
-        print("disconnect:")
+    async def disconnect(self, client: WebSocket, resumable: bool = True):
+        """
+        Disconnects the websocket
 
-        await self.remove_client_from_room(client)
+        If the client has a seat in a game in progress, the seat is kept during the grace window,
+        so that the client can resume the game on a new connection.
+        """
+        if client not in self.conn_ids:
+            return
 
-        if client in self.open_clients:
-            self.open_clients.remove(client)
+        self.last_seen.pop(client, None)
+        self.match_queue.pop(client, None)
+        self.stop_spectating(client)
+
+        # The client is forgotten even if its seat could not be freed, e.g. if the registry is unreachable.
+        try:
+            if resumable and self.session_grace > 0 and await self.is_playing(client):
+                await self.park_seat(client)
+            else:
+                await self.remove_client_from_room(client)
+        finally:
+            self.client_rooms.pop(client, None)
+            self.close_session(client)
 
-            print("     Client removed from open_clients")
+            if client in self.outboxes:
+                self.outboxes.pop(client).close()
 
-        print(f"    Client {client} disconnected")
-        print(f"    open_clients: {self.open_clients}")
-        print(f"    rooms: {self.rooms}")
+            conn_id = self.conn_ids.pop(client, None)
+            self.connections.pop(conn_id, None)
+            self.player_ids.pop(conn_id, None)
+            self.leave_lobby(client)
+
+        logger.info("Client %s disconnected", conn_id)
+        logger.debug("%d open clients", len(self.open_clients))
+
+    async def run_heartbeat(self):
+        """
+        Sends heartbeats to the clients
+
+        This function sends a heartbeat to every client once per interval. Clients answer
+        them, so the ones that have not sent any message for the allowed number of intervals
+        (e.g. because their network connection was silently lost) are disconnected,
+        which frees their seats and stops the lobby updates to them.
+        """
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+
+            deadline = monotonic() - self.heartbeat_interval * self.heartbeat_misses
+            for client, last_seen in list(self.last_seen.items()):
+                if last_seen >= deadline:
+                    self.send(client, {"type": "heartbeat"}, LOBBY_PRIORITY)
+                    continue
+
+                conn_id = self.conn_ids.get(client)
+                logger.info(
+                    "Client %s missed %d heartbeats, disconnecting",
+                    conn_id,
+                    self.heartbeat_misses,
+                )
+
+                # A failure to disconnect one client (e.g. if the registry is unreachable)
+                # must not stop the heartbeats of all others.
+                try:
+                    await self.evict(client)
+                except Exception:
+                    logger.exception("Could not disconnect client %s", conn_id)
+
+    async def evict(self, client: WebSocket, resumable: bool = True):
+        """This function closes the connection to the client and disconnects it right away."""
+        if client in self.outboxes:
+            self.outboxes[client].evict()
+
+        await self.disconnect(client, resumable)
+
+    def open_session(self, client: WebSocket) -> str:
+        """This function creates the session token of the client's seat, replacing its previous one."""
+        self.close_session(client)
+
+        token = token_urlsafe(16)
+        self.session_tokens[client] = token
+        self.sessions[token] = client
+        return token
+
+    def close_session(self, client: WebSocket):
+        """This function drops the session token of the client, if it has one."""
+        token = self.session_tokens.pop(client, None)
+        if token is not None:
+            del self.sessions[token]
+
+    async def is_playing(self, client: WebSocket) -> bool:
+        """This function returns whether the client has a seat in a room whose seats are both taken."""
+        if client not in self.session_tokens:
+            return False
+
+        room = await self.registry.get_room(self.client_rooms[client][0])
+        return room is not None and room["x"] is not None and room["o"] is not None
+
+    async def park_seat(self, client: WebSocket):
+        """
+        Keeps the seat of the disconnected client
+
+        The seat stays taken by the client's connection ID, so the game goes on and the room
+        is not reopened. The other player is told that the client is reconnecting, and the seat
+        is freed if it is not resumed within the grace window.
+        """
+        token = self.session_tokens.pop(client)
+        del self.sessions[token]
+        room_id, sign, owner = self.client_rooms.pop(client)
+        conn_id = self.conn_ids[client]
+
+        self.parked_seats[token] = (conn_id, room_id, sign, owner)
+        self.parked_tokens[conn_id] = token
+        self.expiry_tasks[token] = asyncio.create_task(
+            self.expire_seat(token, self.session_grace)
+        )
+        logger.info("Client %s lost its connection to room %s", conn_id, room_id)
+
+        await self.notify_other_player(
+            room_id, sign, {"type": "player_reconnecting", "grace": self.session_grace}
+        )
+
+    async def expire_seat(self, token: str, delay: float):
+        """This function frees the parked seat once the delay has passed."""
+        await asyncio.sleep(delay)
+
+        del self.expiry_tasks[token]
+        conn_id, room_id, sign, owner = self.parked_seats.pop(token)
+        del self.parked_tokens[conn_id]
+        await self.free_seat(conn_id, room_id, sign, owner)
+
+    async def resume(self, client: WebSocket, token: str):
+        """
+        Resumes the game of a lost connection
+
+        The client takes over the connection ID of the parked seat, so neither the game
+        nor the registry need to change. The worker that owns the room then sends it
+        the state of the game. The token is replaced by a new one.
+        """
+        if client in self.client_rooms:
+            self.send(
+                client,
+                {
+                    "type": "resume_error",
+                    "message": "Leave the room before resuming another one.",
+                },
+            )
+            return
+
+        # The server may not have noticed yet that the previous connection was lost.
+        previous = self.sessions.get(token)
+        if previous is not None and previous is not client:
+            await self.evict(previous)
+
+        if token not in self.parked_seats:
+            self.send(
+                client,
+                {
+                    "type": "resume_error",
+                    "message": "The session has expired.",
+                },
+            )
+            return
+
+        self.expiry_tasks.pop(token).cancel()
+        conn_id, room_id, sign, owner = self.parked_seats.pop(token)
+        del self.parked_tokens[conn_id]
+
+        self.match_queue.pop(client, None)
+        self.stop_spectating(client)
+
+        previous_conn_id = self.conn_ids[client]
+        del self.connections[previous_conn_id]
+        self.conn_ids[client] = conn_id
+        self.connections[conn_id] = client
+        if previous_conn_id in self.player_ids:
+            self.player_ids[conn_id] = self.player_ids.pop(previous_conn_id)
+        self.client_rooms[client] = (room_id, sign, owner)
+        self.leave_lobby(client)
+
+        logger.info("Client %s resumed its seat in room %s", conn_id, room_id)
+        self.send(
+            client,
+            {
+                "type": "resume",
+                "room_id": room_id,
+                "sign": sign,
+                "session": self.open_session(client),
+            },
+        )
+        self.send_game_event(
+            owner, {"type": "resume_game", "room_id": room_id, "conn_id": conn_id}
+        )
+
+        await self.notify_other_player(
+            room_id, sign, {"type": "player_reconnected"}
+        )
+
+    async def notify_other_player(self, room_id: int, sign: str, message: dict):
+        """This function sends the message to the player of the room with the other sign, if there is one."""
+        room = await self.registry.get_room(room_id)
+        if room is None:
+            return
+
+        player = room["o"] if sign == "x" else room["x"]
+        if player is not None:
+            self.send_to(player, message)
 
     async def remove_client_from_room(self, client: WebSocket):
         """This function removes the player from the room."""
-        print("remove_client_from_room:")
-
         # Find room_id and sign of the player.
-        for room_id, room in self.rooms.items():
-            if room["x"] == client:
-                room_id = room_id
-                sign = "x"
-                break
-            elif room["o"] == client:
-                room_id = room_id
-                sign = "o"
-                break
-        else:
-            print(f"     Client {client} is not in the room")
+        if client not in self.client_rooms:
+            logger.debug("Client %s is not in a room", self.conn_ids[client])
 
             return
 
-        # Remove the player from the room.
-        self.rooms[room_id][sign] = None
-        print(f"     Client {client} removed from the room")
+        self.close_session(client)
+        room_id, sign, owner = self.client_rooms.pop(client)
+        await self.free_seat(self.conn_ids[client], room_id, sign, owner)
 
-        # Delete the room if it is empty and update open rooms.
-        room = self.rooms[room_id]
-        if room["x"] is None and room["o"] is None:
-            del self.rooms[room_id]
+    async def free_seat(self, conn_id: str, room_id: int, sign: str, owner: str):
+        """This function removes the player with the connection ID from its seat in the room."""
+        # The game of the room ends when either player leaves.
+        self.send_game_event(owner, {"type": "end_game", "room_id": room_id})
+
+        # Remove the player from the room. The registry deletes the room if it is empty.
+        room = await self.registry.leave_room(room_id, sign)
+        logger.info("Connection %s left room %s", conn_id, room_id)
+
+        # Update open rooms.
+        if room is None:
+            self.registry.publish(LOBBY_CHANNEL, {"removed": [room_id]})
+            self.room_ids.release(room_id)
         else:
             if sign == "x":
                 player = room["o"]
             else:
                 player = room["x"]
 
-            await player.send_json(
+            self.release_opponent(player, room_id)
+
+    def release_opponent(self, conn_id: str, room_id: int):
+        """
+        Handles the other player of the room that a player has left
+
+        The room is reopened for the other player. If the other player's connection was lost,
+        nobody is left to play against it, so its parked seat is freed right away instead.
+        The worker that the other player is connected to handles it.
+        """
+        worker_id = conn_id.split("/")[0]
+        if worker_id != self.worker_id:
+            self.registry.publish(
+                worker_channel(worker_id),
+                {"type": "release_opponent", "conn_id": conn_id, "room_id": room_id},
+            )
+            return
+
+        token = self.parked_tokens.get(conn_id)
+        if token is not None:
+            self.expiry_tasks.pop(token).cancel()
+            self.expiry_tasks[token] = asyncio.create_task(self.expire_seat(token, 0))
+            return
+
+        self.registry.publish(LOBBY_CHANNEL, {"added": [room_id]})
+        self.send_to(
+            conn_id,
+            {
+                "type": "player_disconnected",
+            },
+        )
+
+    async def quick_match(self, client: WebSocket) -> tuple[int, str, str] | None:
+        """
+        Matches the client with another player
+
+        This function pairs the client with the player that has waited the longest
+        for a quick match, in a new room that is never listed in the lobby.
+        Returns the room ID and the connection IDs of both players, or None if the client
+        has to wait for another player.
+        """
+        if client in self.client_rooms or client in self.match_queue:
+            return None
+
+        self.stop_spectating(client)
+
+        opponent = next(iter(self.match_queue), None)
+        if opponent is None:
+            self.match_queue[client] = None
+            self.send(client, {"type": "quick_match", "status": "waiting"})
+            return None
+
+        del self.match_queue[opponent]
+        player_x, player_o = self.conn_ids[opponent], self.conn_ids[client]
+
+        room_id = self.room_ids.allocate()
+        while not await self.registry.create_room(room_id, self.worker_id, player_x):
+            room_id = self.room_ids.allocate()
+        await self.registry.join_room(room_id, player_o)
+
+        for player, sign in ((opponent, "x"), (client, "o")):
+            self.client_rooms[player] = (room_id, sign, self.worker_id)
+            self.leave_lobby(player)
+
+            self.send(
+                player,
+                {
+                    "type": "join_room",
+                    "room_id": room_id,
+                    "sign": sign,
+                    "session": self.open_session(player),
+                },
+            )
+
+        return room_id, player_x, player_o
+
+    async def spectate_room(self, client: WebSocket, room_id: int):
+        """
+        Makes the websocket spectate a room
+
+        Spectators receive the updates of the room's game, but cannot move.
+        The worker that owns the room adds the client to the spectators of its game
+        and sends it the scores and the board. If the room has no game in progress,
+        the owner rejects the client, which is then sent back to the lobby.
+        """
+        if client in self.client_rooms:
+            self.send(
+                client,
+                {
+                    "type": "spectate_room_error",
+                    "message": "Players cannot spectate a room.",
+                },
+            )
+            return
+
+        self.match_queue.pop(client, None)
+        self.stop_spectating(client)
+
+        shard_url = self.registry.get_room_shard_url(room_id)
+        if shard_url is not None:
+            self.send(
+                client,
                 {
-                    "type": "player_disconnected",
-                }
+                    "type": "spectate_room_redirect",
+                    "room_id": room_id,
+                    "url": shard_url,
+                },
+            )
+            return
+
+        room = await self.registry.get_room(room_id)
+        if room is None:
+            self.send(
+                client,
+                {
+                    "type": "spectate_room_error",
+                    "message": f"Room {room_id} does not exist.",
+                },
+            )
+            return
+
+        self.spectating[client] = (room_id, room["owner"])
+        self.leave_lobby(client)
+
+        self.send_game_event(
+            room["owner"],
+            {
+                "type": "add_spectator",
+                "room_id": room_id,
+                "conn_id": self.conn_ids[client],
+            },
+        )
+
+    def reject_spectator(self, conn_id: str, room_id: int, message: str):
+        """
+        Rejects the spectator of the room
+
+        The spectator is sent back to the lobby by the worker it is connected to,
+        so the rejection is relayed to that worker if it is not this one.
+        """
+        client = self.connections.get(conn_id)
+        if client is None:
+            worker_id = conn_id.split("/")[0]
+            if worker_id != self.worker_id:
+                self.registry.publish(
+                    worker_channel(worker_id),
+                    {
+                        "type": "reject_spectator",
+                        "conn_id": conn_id,
+                        "room_id": room_id,
+                        "message": message,
+                    },
+                )
+            return
+
+        # The client may have moved on since it asked to spectate the room.
+        spectating = self.spectating.get(client)
+        if spectating is None or spectating[0] != room_id:
+            return
+
+        del self.spectating[client]
+        self.send(client, {"type": "spectate_room_error", "message": message})
+        self.enter_lobby(client)
+
+    def end_spectating(self, conn_ids: list[str], room_id: int):
+        """
+        Sends the spectators of the room back to the lobby once its game has ended
+
+        The spectators of other workers are sent back by their workers,
+        which are relayed a single message each.
+        """
+        message = SharedMessage({"type": "spectate_ended"})
+
+        remote = {}
+        for conn_id in conn_ids:
+            worker_id = conn_id.split("/")[0]
+            if worker_id != self.worker_id:
+                remote.setdefault(worker_id, []).append(conn_id)
+                continue
+
+            # The client may have moved on since the game ended.
+            client = self.connections.get(conn_id)
+            spectating = self.spectating.get(client)
+            if spectating is None or spectating[0] != room_id:
+                continue
+
+            del self.spectating[client]
+            self.send(client, message)
+            self.enter_lobby(client)
+
+        for worker_id, recipients in remote.items():
+            self.registry.publish(
+                worker_channel(worker_id),
+                {"type": "end_spectating", "conn_ids": recipients, "room_id": room_id},
             )
 
+    def stop_spectating(self, client: WebSocket):
+        """This function removes the client from the spectators of the room it is spectating, if any."""
+        if client not in self.spectating:
+            return
+
+        room_id, owner = self.spectating.pop(client)
+        self.send_game_event(
+            owner,
+            {
+                "type": "remove_spectator",
+                "room_id": room_id,
+                "conn_id": self.conn_ids[client],
+            },
+        )
+
     async def leave_room(self, client: WebSocket):
         """Makes the websocket leave the room"""
+        self.match_queue.pop(client, None)
+        self.stop_spectating(client)
         await self.remove_client_from_room(client)
 
-        self.open_clients.append(client)
-
-        await client.send_json(
+        self.send(
+            client,
             {
                 "type": "leave_room",
-            }
+            },
         )
 
-        await self.update_open_rooms()
+        self.enter_lobby(client)
+
+    def enter_lobby(self, client: WebSocket):
+        """This function adds the client to the open clients and sends it the open rooms, which it may have missed."""
+        if client not in self.open_clients:
+            self.open_clients.append(client)
+
+        self.send(client, self.get_lobby_snapshot(), LOBBY_PRIORITY)
+
+    def leave_lobby(self, client: WebSocket):
+        """This function removes the client from the open clients, if it is one of them."""
+        if client in self.open_clients:
+            self.open_clients.remove(client)
+
+    def send(
+        self,
+        client: WebSocket,
+        message: dict | SharedMessage,
+        priority: int = GAME_PRIORITY,
+    ):
+        """
+        Sends the message to the client
+
+        This function queues the message in the client's outbox, so it never waits
+        for the client's network connection. Returns False if the message was dropped.
+        """
+        outbox = self.outboxes.get(client)
+        if outbox is None:
+            return False
+
+        return outbox.send(message, priority)
+
+    def send_to(
+        self,
+        conn_id: str,
+        message: dict | SharedMessage,
+        priority: int = GAME_PRIORITY,
+    ):
+        """
+        Sends the message to the connection
+
+        The connection may belong to another worker, in which case the message
+        is relayed to that worker through the registry.
+        """
+        client = self.connections.get(conn_id)
+        if client is not None:
+            return self.send(client, message, priority)
+
+        worker_id = conn_id.split("/")[0]
+        if worker_id == self.worker_id:
+            # The connection was closed.
+            return False
+
+        if isinstance(message, SharedMessage):
+            message = message.message
+
+        self.registry.publish(
+            worker_channel(worker_id),
+            {
+                "type": "deliver",
+                "to": conn_id,
+                "message": message,
+                "priority": priority,
+            },
+        )
+        return True
+
+    def get_player_ids(self, *conn_ids: str) -> dict[str, str]:
+        """This function returns the player IDs of the connections of this worker among the given ones."""
+        return {
+            conn_id: self.player_ids[conn_id]
+            for conn_id in conn_ids
+            if conn_id in self.player_ids
+        }
+
+    def send_many(
+        self,
+        conn_ids: list[str],
+        message: SharedMessage,
+        priority: int = GAME_PRIORITY,
+    ):
+        """
+        Sends the message to all the connections
+
+        The same message is queued in the outboxes of the local connections, so it is
+        only encoded once per codec. The connections of other workers are sent
+        a single relayed message per worker.
+        """
+        remote = {}
+        for conn_id in conn_ids:
+            client = self.connections.get(conn_id)
+            if client is not None:
+                self.send(client, message, priority)
+                continue
+
+            worker_id = conn_id.split("/")[0]
+            if worker_id != self.worker_id:
+                remote.setdefault(worker_id, []).append(conn_id)
+
+        for worker_id, recipients in remote.items():
+            self.registry.publish(
+                worker_channel(worker_id),
+                {
+                    "type": "deliver",
+                    "to": recipients,
+                    "message": message.message,
+                    "priority": priority,
+                },
+            )
+
+    def relay_game_event(self, client: WebSocket, event: dict):
+        """
+        Runs the game event of the client's room
+
+        The event is queued right away if this worker owns the room,
+        otherwise it is relayed to the owner worker through the registry.
+        """
+        if client not in self.client_rooms:
+            return
+
+        _, _, owner = self.client_rooms[client]
+        self.send_game_event(owner, event)
+
+    def send_game_event(self, owner: str, event: dict):
+        """This function passes the game event to the handler of the owner worker."""
+        if owner == self.worker_id:
+            self.game_event_handler(event)
+        else:
+            self.registry.publish(worker_channel(owner), event)
+
+    def on_worker_message(self, message: dict):
+        """This function handles the messages relayed to this worker by the other workers."""
+        if message["type"] == "release_opponent":
+            self.release_opponent(message["conn_id"], message["room_id"])
+        elif message["type"] == "end_spectating":
+            self.end_spectating(message["conn_ids"], message["room_id"])
+        elif message["type"] == "reject_spectator":
+            self.reject_spectator(
+                message["conn_id"], message["room_id"], message["message"]
+            )
+        elif message["type"] == "deliver":
+            # Messages to many connections are relayed with a list of recipients.
+            if isinstance(message["to"], list):
+                self.send_many(
+                    message["to"], SharedMessage(message["message"]), message["priority"]
+                )
+                return
+
+            client = self.connections.get(message["to"])
+            if client is not None:
+                self.send(client, message["message"], message["priority"])
+        else:
+            self.game_event_handler(message)
+
+    def on_lobby_change(self, change: dict):
+        """This function applies the changes to the open rooms published by any worker and schedules a lobby update."""
+        for room_id in change.get("added", ()):
+            self.open_room(room_id)
+        for room_id in change.get("removed", ()):
+            self.close_room(room_id)
+
+        self.notify_open_rooms()
+
+    def open_room(self, room_id: int):
+        """Adds the room to the open rooms and records the change for the next lobby update."""
+        if room_id in self.open_rooms:
+            return
+
+        self.open_rooms[room_id] = None
+
+        # The open clients still know about the room if its removal has not been sent yet.
+        if room_id in self.rooms_removed:
+            del self.rooms_removed[room_id]
+        else:
+            self.rooms_added[room_id] = None
+
+    def close_room(self, room_id: int):
+        """Removes the room from the open rooms and records the change for the next lobby update."""
+        if room_id not in self.open_rooms:
+            return
+
+        del self.open_rooms[room_id]
+
+        # The open clients never heard about the room if its addition has not been sent yet.
+        if room_id in self.rooms_added:
+            del self.rooms_added[room_id]
+        else:
+            self.rooms_removed[room_id] = None
+
+    async def sync_open_rooms(self):
+        """
+        Loads the open rooms from the registry
+
+        Changes to the open rooms that were missed, e.g. while the connection to the registry
+        was lost, are sent to the open clients with the next lobby update.
+        """
+        open_rooms = await self.registry.get_open_rooms()
+
+        registered = set(open_rooms)
+        for room_id in list(self.open_rooms):
+            if room_id not in registered:
+                self.close_room(room_id)
+        for room_id in open_rooms:
+            self.open_room(room_id)
+
+        self.notify_open_rooms()
 
     async def get_open_rooms(self):
         """This function returns list of all rooms that have only one connected player."""
-        print("conn_manager.get_open_rooms:")
+        return list(self.open_rooms)
+
+    def get_lobby_snapshot(self) -> SharedMessage:
+        """
+        Gets the open rooms as of the current lobby version
+
+        Changes that have not been sent to the open clients yet are left out, since clients
+        get them with the next delta. The message is only built once per lobby version,
+        and encoded once per codec for all clients that ask for it.
+        """
+        snapshot = self.lobby_snapshot
+        if snapshot is not None and snapshot.message["version"] == self.lobby_version:
+            return snapshot
 
         open_rooms = [
-            room_id
-            for room_id, room in self.rooms.items()
-            if None in [room["x"], room["o"]]
+            room_id for room_id in self.open_rooms if room_id not in self.rooms_added
         ]
+        open_rooms.extend(self.rooms_removed)
 
-        print(f"    rooms: {self.rooms}")
-        print(f"    open_rooms: {open_rooms}")
+        self.lobby_snapshot = SharedMessage(
+            {
+                "type": "update_open_rooms",
+                "open_rooms": open_rooms,
+                "version": self.lobby_version,
+            }
+        )
+        return self.lobby_snapshot
 
-        return open_rooms
+    def notify_open_rooms(self):
+        """
+        Schedules an update of open rooms
+
+        This function makes sure that the lobby changes are sent to the open clients
+        once the flush interval has passed, so that all changes made in the meantime
+        are sent in a single update.
+        """
+        self.lobby_stats["notifications"] += 1
+
+        if self.lobby_flush_task is None:
+            self.lobby_flush_task = asyncio.create_task(self.flush_open_rooms())
+
+    async def flush_open_rooms(self):
+        """This function waits for the flush interval and then sends the collected lobby changes."""
+        await asyncio.sleep(self.lobby_flush_interval)
+
+        # Changes made while the update is being sent will schedule a new flush.
+        self.lobby_flush_task = None
+        self.lobby_stats["flushes"] += 1
+
+        await self.update_open_rooms()
 
     async def update_open_rooms(self):
         """
         Updates open rooms
 
-        This function sends information about new rooms to clients
-        that are not connected to room.
+        This function sends the rooms that were opened or closed since the last update
+        to clients that are not connected to room, tagged with the new lobby version.
         """
-        print("update_open_rooms:")
+        if not self.rooms_added and not self.rooms_removed:
+            return
 
-        open_rooms = await self.get_open_rooms()
+        traced = tracer.sampled()
+        if traced:
+            started = perf_counter()
 
-        print(f"    open_clients: {self.open_clients}")
+        self.lobby_version += 1
+        rooms_added = list(self.rooms_added)
+        rooms_removed = list(self.rooms_removed)
+        self.rooms_added = {}
+        self.rooms_removed = {}
 
+        logger.debug(
+            "Sending lobby version %d (%d rooms added, %d removed) to %d open clients",
+            self.lobby_version,
+            len(rooms_added),
+            len(rooms_removed),
+            len(self.open_clients),
+        )
+
+        # The delta is encoded once per codec for all open clients.
+        message = SharedMessage(
+            {
+                "type": "update_open_rooms_delta",
+                "version": self.lobby_version,
+                "rooms_added": rooms_added,
+                "rooms_removed": rooms_removed,
+            }
+        )
+
+        # Messages are only queued, so one slow client does not hold up the others.
         for client in self.open_clients:
-            await client.send_json(
-                {
-                    "type": "update_open_rooms",
-                    "open_rooms": open_rooms,
-                }
+            self.send(client, message, LOBBY_PRIORITY)
+
+        if traced:
+            tracer.record(
+                "update_open_rooms",
+                LOBBY_TID,
+                started,
+                perf_counter(),
+                {"clients": len(self.open_clients)},
             )
+
+        logger.debug("Send stats: %s", self.send_stats)
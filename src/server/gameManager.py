@@ -1,24 +1,241 @@
 """This file contains definition of GameManager class."""
 
 
-from fastapi import WebSocket
+import asyncio
+import logging
+from time import monotonic, perf_counter, time
+
+from server.codec import SharedMessage
+from server.connectionManager import ConnectionManager
+from server.logs import MOVE_LOGGER_NAME
+from server.results import ResultStore
+from server.tracing import GAME_TID, tracer
+
+logger = logging.getLogger(__name__)
+move_logger = logging.getLogger(MOVE_LOGGER_NAME)
+
+# Number of events waiting in the inbox of a single room over which new moves are dropped.
+# Other events, such as the end of the game, are always queued.
+INBOX_SIZE = 256
+
+# Number of spectators that a spectator feed sends a message to before letting other tasks run.
+FEED_CHUNK = 256
+
+# Seconds of the countdown that the clients show before every round.
+ROUND_COUNTDOWN = 3.0
+
+# Each player's marks are stored as a 9-bit integer, where bit `n` is cell `n` of the board.
+FULL_BOARD = 0b111111111
+
+# Maps every winning line's bitmask to the tuple of cells that it covers.
+WIN_MASKS = {
+    sum(1 << cell for cell in cells): cells
+    for cells in (
+        # Rows
+        (0, 1, 2),
+        (3, 4, 5),
+        (6, 7, 8),
+        # Columns
+        (0, 3, 6),
+        (1, 4, 7),
+        (2, 5, 8),
+        # Diagonals
+        (0, 4, 8),
+        (2, 4, 6),
+    )
+}
 
 
 class GameManager:
-    """This class handles games."""
+    """
+    This class handles games.
+
+    Every room with a game runs as an actor: a task that owns the room's game and handles
+    the events from its inbox one at a time. Events are only ever queued by the code
+    receiving them, so the events of a room are handled in order and never interleave.
 
-    def __init__(self):
+    Games with spectators also have a spectator feed: a task that sends the game's updates
+    to all spectators in chunks, so a large audience never delays the players' events.
+    """
+
+    def __init__(
+        self, conn_manager: ConnectionManager, results: ResultStore | None = None
+    ):
         # List of all games.
         self.games = {}
 
-    async def send_both(self, game: dict, message: dict):
-        """Send a message to both players."""
+        # Connection manager that delivers messages to the players, which may be connected to other workers.
+        self.conn_manager = conn_manager
+
+        # Store that the finished rounds and matches are recorded in, if any.
+        self.results = results
+
+        # Inbox and actor task of every room that has received a game event.
+        self.inboxes = {}
+        self.actors = {}
+
+        # Spectator feed task of every game that has had spectators.
+        self.feeds = {}
+
+    def post(self, event: dict):
+        """Queues the game event in the inbox of its room, starting the room's actor if needed."""
+        room_id = event["room_id"]
+
+        inbox = self.inboxes.get(room_id)
+        if inbox is None:
+            if event["type"] == "add_spectator":
+                self.reject_spectator(room_id, event["conn_id"])
+            if event["type"] != "start_game":
+                # The room has no game to apply the event to.
+                return
+
+            inbox = self.inboxes[room_id] = asyncio.Queue()
+            self.actors[room_id] = asyncio.create_task(self.run_room(room_id, inbox))
+
+        if event["type"] == "move" and inbox.qsize() >= INBOX_SIZE:
+            logger.warning("Inbox of room %s is full, dropping %s", room_id, event)
+            return
+
+        inbox.put_nowait(event)
+
+    async def run_room(self, room_id: int, inbox: asyncio.Queue):
+        """This function handles the events of the room until its game has ended and its inbox is empty."""
+        while True:
+            event = await inbox.get()
+
+            traced = tracer.sampled()
+            if traced:
+                started = perf_counter()
+
+            try:
+                self.handle_event(event)
+            except Exception:
+                logger.exception("Room %s: could not handle %s", room_id, event)
+
+            if traced:
+                tracer.record(
+                    event["type"], GAME_TID, started, perf_counter(), {"room": room_id}
+                )
+
+            # A new game may have been started while the last one was ending.
+            if room_id not in self.games and inbox.empty():
+                del self.inboxes[room_id]
+                del self.actors[room_id]
+                return
+
+    def stop(self):
+        """This function stops the actors of all rooms."""
+        for actor in self.actors.values():
+            actor.cancel()
+        for feed in self.feeds.values():
+            feed.cancel()
+
+    def handle_event(self, event: dict):
+        """This function runs the game event in the actor of its room."""
+        match event["type"]:  # noqa: E999
+            case "start_game":
+                self.start_game(
+                    event["room_id"],
+                    event["player_x"],
+                    event["player_o"],
+                    event.get("player_ids"),
+                )
+
+            case "get_board":
+                self.send_board(event["room_id"], event["conn_id"])
+
+            case "resume_game":
+                self.send_state(event["room_id"], event["conn_id"])
+
+            case "move":
+                if event["room_id"] in self.games:
+                    self.move(event["room_id"], event["sign"], event["cell"])
+
+            case "add_spectator":
+                self.add_spectator(event["room_id"], event["conn_id"])
+
+            case "remove_spectator":
+                game = self.games.get(event["room_id"])
+                if game is not None:
+                    game["spectators"].pop(event["conn_id"], None)
+
+            case "end_game":
+                game = self.games.pop(event["room_id"], None)
+                if game is not None:
+                    self.record_match(event["room_id"], game)
+                if game is not None and game["feed"] is not None:
+                    # Stop the feed once it has sent everything, which sends the spectators back to the lobby.
+                    game["feed"].put_nowait(None)
+
+    def send_both(self, game: dict, message: dict):
+        """Send a message to both players, then queue it for the spectators."""
+        # The message is encoded once per codec for all its recipients.
+        message = SharedMessage(message)
         for player in (game["player_x"], game["player_o"]):
-            await player.send_json(message)
+            self.conn_manager.send_to(player, message)
+
+        if game["spectators"]:
+            game["feed"].put_nowait(message)
+
+    def add_spectator(self, room_id: int, conn_id: str):
+        """Adds the connection to the spectators of the game and sends it the scores and the board."""
+        game = self.games.get(room_id)
+        if game is None:
+            self.reject_spectator(room_id, conn_id)
+            return
+
+        if game["feed"] is None:
+            game["feed"] = asyncio.Queue()
+            self.feeds[room_id] = asyncio.create_task(
+                self.run_feed(room_id, game["feed"], game["spectators"])
+            )
+
+        game["spectators"][conn_id] = None
+        self.conn_manager.send_to(
+            conn_id,
+            {
+                "type": "spectate_room",
+                "room_id": room_id,
+                "round": game["played_rounds"],
+                "x_wins": game["x_wins"],
+                "o_wins": game["o_wins"],
+            },
+        )
+        self.conn_manager.send_to(conn_id, self.get_board_message(game))
+
+    def reject_spectator(self, room_id: int, conn_id: str):
+        """Tells the connection that the room it wants to spectate has no game in progress."""
+        self.conn_manager.reject_spectator(
+            conn_id, room_id, f"Room {room_id} has no game in progress."
+        )
+
+    async def run_feed(self, room_id: int, feed: asyncio.Queue, spectators: dict):
+        """
+        Sends the messages of the feed to the spectators of the game
 
-    async def start_round(self, game: dict, round: int):
+        Every message is encoded once per codec and queued in the spectators' outboxes,
+        whose writers send it concurrently. Other tasks, such as the actors handling
+        the players' moves, run between every chunk of spectators.
+        """
+        while True:
+            message = await feed.get()
+            if message is None:
+                self.conn_manager.end_spectating(list(spectators), room_id)
+                break
+
+            recipients = list(spectators)
+            for start in range(0, len(recipients), FEED_CHUNK):
+                end = start + FEED_CHUNK
+                self.conn_manager.send_many(recipients[start:end], message)
+                await asyncio.sleep(0)
+
+        if self.feeds.get(room_id) is asyncio.current_task():
+            del self.feeds[room_id]
+
+    def start_round(self, game: dict, round: int):
         """Starts the round"""
-        await self.send_both(
+        game["round_started"] = monotonic()
+        self.send_both(
             game,
             {
                 "type": "start_countdown",
@@ -27,60 +244,161 @@ class GameManager:
             },
         )
 
+        # Resynchronise the players' boards at the start of every round.
+        self.send_both(game, self.get_board_message(game))
+
+    def send_board(self, room_id: int, player: str):
+        """Sends the full board to the player, e.g. after it has missed a cell update."""
+        game = self.games.get(room_id)
+        if game is None:
+            return
+
+        self.conn_manager.send_to(player, self.get_board_message(game))
+
+    def send_state(self, room_id: int, player: str):
+        """
+        Sends the state of the game to the player that has resumed it
+
+        The state holds the board, the scores, the round and the seconds left of its countdown.
+        If the game has ended in the meantime, the player is told to wait for another one.
+        """
+        game = self.games.get(room_id)
+        if game is None:
+            self.conn_manager.send_to(player, {"type": "player_disconnected"})
+            return
+
+        countdown = ROUND_COUNTDOWN - (monotonic() - game["round_started"])
+        self.conn_manager.send_to(
+            player,
+            {
+                "type": "game_state",
+                "board": self.get_board(game),
+                "seq": game["seq"],
+                "x_wins": game["x_wins"],
+                "o_wins": game["o_wins"],
+                "round": game["played_rounds"],
+                "countdown": round(max(countdown, 0.0), 3),
+            },
+        )
+
     def reset_board(self, room_id: int):
         """Resets the board"""
-        self.games[room_id]["board"] = [
-            ["*", "*", "*"],
-            ["*", "*", "*"],
-            ["*", "*", "*"],
-        ]
-
-    async def start_game(self, room_id: int, player_x: WebSocket, player_o: WebSocket):
-        """Starts the game."""
+        game = self.games[room_id]
+        game["x"] = 0
+        game["o"] = 0
+        game["seq"] += 1
+
+    def get_board(self, game: dict) -> list:
+        """Builds the board in the format that is sent to the clients from the game's bitboards."""
+        x_bits = game["x"]
+        o_bits = game["o"]
+        board = []
+        for row in range(3):
+            board_row = []
+            for cell in range(row * 3, row * 3 + 3):
+                bit = 1 << cell
+                if x_bits & bit:
+                    board_row.append("x")
+                elif o_bits & bit:
+                    board_row.append("o")
+                else:
+                    board_row.append("*")
+            board.append(board_row)
+        return board
+
+    def get_board_message(self, game: dict) -> dict:
+        """Builds message with type 'update_board' containing the full board and its sequence number."""
+        return {
+            "type": "update_board",
+            "board": self.get_board(game),
+            "seq": game["seq"],
+        }
+
+    def start_game(
+        self,
+        room_id: int,
+        player_x: str,
+        player_o: str,
+        player_ids: dict[str, str] | None = None,
+    ):
+        """
+        Starts the game between the players with the given connection IDs.
+
+        The player IDs of the connections are looked up on this worker, or taken from the given ones
+        for connections of other workers. Players without an ID are recorded as None.
+        """
+        player_ids = {
+            **(player_ids or {}),
+            **self.conn_manager.get_player_ids(player_x, player_o),
+        }
+
         # Create game.
         self.games[room_id] = {
             "player_x": player_x,
             "player_o": player_o,
-            "board": [
-                ["*", "*", "*"],
-                ["*", "*", "*"],
-                ["*", "*", "*"],
-            ],
+            # Player IDs that the results of the game are recorded under, and the time it started.
+            "player_ids": (player_ids.get(player_x), player_ids.get(player_o)),
+            "started_at": time(),
+            "x": 0,
+            "o": 0,
+            # Sequence number of the last change to the board.
+            "seq": 0,
             "x_wins": 0,
             "o_wins": 0,
             "played_rounds": 1,
+            # Time at which the countdown of the current round started.
+            "round_started": 0.0,
+            # Connection IDs of the spectators, as an insertion-ordered set,
+            # and the queue of their spectator feed once they have joined.
+            "spectators": {},
+            "feed": None,
         }
 
-        await self.start_round(self.games[room_id], 1)
+        self.start_round(self.games[room_id], 1)
 
-    async def move(self, room_id: int, sign: str, cell: int):
-        """This function updates the board and sends message with type 'update_board' to both players."""
+    def move(self, room_id: int, sign: str, cell: int):
+        """This function updates the board and sends message with type 'cell_set' to both players."""
         game = self.games[room_id]
-        board = game["board"]
 
-        # Update board dict.
-        cell_row = cell // 3
-        cell_col = cell % 3
-        board[cell_row][cell_col] = sign
+        # Ignore moves of unknown signs, and moves to cells that are out of the board or already taken.
+        if sign not in ("x", "o"):
+            return
+        if not isinstance(cell, int) or not 0 <= cell < 9:
+            return
+        bit = 1 << cell
+        if (game["x"] | game["o"]) & bit:
+            return
+
+        # Update the player's bitboard.
+        game[sign] |= bit
+        game["seq"] += 1
+        move_logger.debug("Room %s: %s moved to cell %d", room_id, sign, cell)
 
-        # Send "update_board" message.
-        await self.send_both(
+        # Send "cell_set" message.
+        self.send_both(
             game,
             {
-                "type": "update_board",
-                "board": board,
+                "type": "cell_set",
+                "cell": cell,
+                "sign": sign,
+                "seq": game["seq"],
             },
         )
 
-        # Check win_board.
-        winner, win_cells = self.check_win_round(board)
+        # Check win_round.
+        winner, win_cells = self.check_win_round(game, sign)
+
+        if winner is not None:
+            logger.debug(
+                "Room %s: %s won round %d", room_id, winner, game["played_rounds"]
+            )
 
-        if (winner, win_cells) != (None, None):
             # Update winner score.
             game[winner + "_wins"] += 1
+            self.record_round(room_id, game, winner)
 
             # Send "win_round" message.
-            await self.send_both(
+            self.send_both(
                 game,
                 {
                     "type": "win_round",
@@ -92,14 +410,17 @@ class GameManager:
             )
 
             game["played_rounds"] += 1
-            await self.start_round(game, game["played_rounds"])
             self.reset_board(room_id)
+            self.start_round(game, game["played_rounds"])
 
         # Check for draw_round.
-        if self.check_draw_round(board):
+        elif self.check_draw_round(game):
+            logger.debug("Room %s: round %d was a draw", room_id, game["played_rounds"])
+
             game["x_wins"] += 1
             game["o_wins"] += 1
-            await self.send_both(
+            self.record_round(room_id, game, None)
+            self.send_both(
                 game,
                 {
                     "type": "draw_round",
@@ -109,44 +430,46 @@ class GameManager:
             )
 
             game["played_rounds"] += 1
-            await self.start_round(game, game["played_rounds"])
             self.reset_board(room_id)
+            self.start_round(game, game["played_rounds"])
 
         # Check is game is over
 
-    def check_win_round(self, board: list):
-        """This methon checks if the current player is won."""
-        print(board)
-
-        # Check if current player filled one of the rows
-        for row_i, row in enumerate(board):
-            if len(set(row)) == 1 and "*" not in row:
-                print(f"{row[0]} won:", (row_i * 3, row_i * 3 + 1, row_i * 3 + 2))
-                return row[0], (row_i * 3, row_i * 3 + 1, row_i * 3 + 2)
-
-        # Check if current player filled one of the columns
-        columns = [[board[i][j] for i in range(3)] for j in range(3)]
-        for col_i, col in enumerate(columns):
-            if len(set(col)) == 1 and "*" not in col:
-                print(f"{col[0]} won:", (col_i, col_i + 3, col_i + 6))
-                return col[0], (col_i, col_i + 3, col_i + 6)
-
-        # Check if current player filled first diagonal
-        d_1 = [board[i][i] for i in range(3)]
-        if len(set(d_1)) == 1 and "*" not in d_1:
-            print(f"{d_1[0]} won:", (0, 4, 8))
-            return d_1[0], (0, 4, 8)
-
-        d_2 = [board[i][2 - i] for i in range(3)]
-        if len(set(d_2)) == 1 and "*" not in d_2:
-            print(f"{d_2[0]} won:", (2, 4, 6))
-            return d_2[0], (2, 4, 6)
-
-        # Otherwise, return False
+    def is_recorded(self, game: dict) -> bool:
+        """This function returns whether the results of the game are recorded, which needs at least one player ID."""
+        return self.results is not None and game["player_ids"] != (None, None)
+
+    def record_round(self, room_id: int, game: dict, winner: str | None):
+        """This function records the result of the current round. The winner is None for a draw."""
+        if self.is_recorded(game):
+            self.results.record_round(
+                room_id, game["played_rounds"], *game["player_ids"], winner
+            )
+
+    def record_match(self, room_id: int, game: dict):
+        """This function records the final scores of the game, if at least one round was played."""
+        if self.is_recorded(game) and game["played_rounds"] > 1:
+            self.results.record_match(
+                room_id,
+                *game["player_ids"],
+                game["x_wins"],
+                game["o_wins"],
+                game["played_rounds"] - 1,
+                game["started_at"],
+            )
+
+    def check_win_round(self, game: dict, sign: str):
+        """This method checks if the player with the given sign has won."""
+        bits = game[sign]
+
+        # Only the player that has just moved can have completed a line.
+        for mask, cells in WIN_MASKS.items():
+            if bits & mask == mask:
+                return sign, cells
+
+        # Otherwise, return (None, None)
         return (None, None)
 
-    def check_draw_round(self, board):
+    def check_draw_round(self, game: dict):
         """Check if it is a draw round."""
-        print("draw", board)
-
-        return all([row.count("*") == 3 for row in board])
+        return game["x"] | game["o"] == FULL_BOARD
@@ -0,0 +1,85 @@
+"""This file contains the logging setup of the server."""
+
+import json
+import logging
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+from random import random
+
+# Logger of per-move events, which are only written for a sample of the moves.
+MOVE_LOGGER_NAME = "server.moves"
+
+TEXT_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+
+class SamplingFilter(logging.Filter):
+    """Lets through only the given fraction of the records."""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        """Decides if the record is written."""
+        return self.rate >= 1 or random() < self.rate
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats every record as a single JSON object per line."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        """Formats the record."""
+        entry = {
+            "time": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class DeferredQueueHandler(QueueHandler):
+    """
+    Puts the records in the queue as they are.
+
+    The default queue handler formats the message and the traceback of every record before
+    queueing it. This one leaves all formatting to the handlers of the listener thread, so the
+    arguments of a message are formatted as they are once the listener gets to them.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """Returns the record without formatting it."""
+        return record
+
+
+def setup_logging(
+    level: str = "INFO", log_format: str = "text", move_sample_rate: float = 1.0
+) -> QueueListener:
+    """
+    Sets up the logging of the server.
+
+    The loggers only put the records in a queue. They are formatted, including their arguments
+    and tracebacks, and written to stderr by a listener thread, so that the event loop never waits
+    for the output. Records of disabled levels are not even created, so those calls cost next to nothing.
+    Returns the listener, which has to be stopped when the server shuts down.
+    """
+    handler = logging.StreamHandler()
+    if log_format == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+
+    queue = SimpleQueue()
+    listener = QueueListener(queue, handler)
+
+    logger = logging.getLogger("server")
+    logger.setLevel(level.upper())
+    logger.addHandler(DeferredQueueHandler(queue))
+    logger.propagate = False
+
+    logging.getLogger(MOVE_LOGGER_NAME).addFilter(SamplingFilter(move_sample_rate))
+
+    listener.start()
+    return listener
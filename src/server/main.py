@@ -5,20 +5,123 @@
 # - rounds
 # -
 
-from json import loads
+import logging
+from os import getenv
+from secrets import compare_digest
+from time import perf_counter
 
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
-from fastapi.responses import RedirectResponse
+from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
+from fastapi.responses import PlainTextResponse, RedirectResponse
 from fastapi.staticfiles import StaticFiles
 
-from server.connectionManager import ConnectionManager
+from server.connectionManager import (
+    HEARTBEAT_INTERVAL, HEARTBEAT_MISSES, LOBBY_FLUSH_INTERVAL, SESSION_GRACE,
+    ConnectionManager
+)
 from server.gameManager import GameManager
+from server.logs import setup_logging
+from server.metrics import CONTENT_TYPE, Metrics
+from server.outbox import LOBBY_PRIORITY
+from server.ratelimit import RATE_LIMIT_STRIKES, RateLimiter, parse_rate_limits
+from server.registry import InMemoryRegistry, RedisRegistry, ShardRegistry
+from server.results import HISTORY_LIMIT, HISTORY_MAX_LIMIT, ResultStore
+from server.tracing import RECEIVE_TID, TRACE_BUFFER_SIZE, tracer
+
+log_listener = setup_logging(
+    level=getenv("LOG_LEVEL", "INFO"),
+    log_format=getenv("LOG_FORMAT", "text"),
+    move_sample_rate=float(getenv("LOG_MOVE_SAMPLE_RATE", "0.01")),
+)
+logger = logging.getLogger(__name__)
+
+# Tracing of a sample of the messages, off by default.
+tracer.configure(
+    sample_rate=float(getenv("TRACE_SAMPLE_RATE", "0")),
+    capacity=int(getenv("TRACE_BUFFER_SIZE", TRACE_BUFFER_SIZE)),
+)
+
+# Token required by the admin endpoints, which are disabled if it is not set.
+ADMIN_TOKEN = getenv("ADMIN_TOKEN")
 
 app = FastAPI()
 app.mount("/client", StaticFiles(directory="client", html=True), name="client")
 
-conn_manager = ConnectionManager()
-game_manager = GameManager()
+# Rooms are shared by all workers through Redis if its URL is given.
+# When the server runs as shards (see `server.supervisor`), every shard keeps its own rooms.
+registry_url = getenv("REGISTRY_URL")
+shard_urls = getenv("SHARD_URLS")
+if registry_url:
+    registry = RedisRegistry(registry_url)
+elif shard_urls:
+    registry = ShardRegistry(
+        int(getenv("SHARD_INDEX", "0")), shard_urls.split(","), getenv("SHARD_TOKEN", "")
+    )
+else:
+    registry = InMemoryRegistry()
+
+conn_manager = ConnectionManager(
+    lobby_flush_interval=float(getenv("LOBBY_FLUSH_INTERVAL", LOBBY_FLUSH_INTERVAL)),
+    registry=registry,
+    heartbeat_interval=float(getenv("HEARTBEAT_INTERVAL", HEARTBEAT_INTERVAL)),
+    heartbeat_misses=int(getenv("HEARTBEAT_MISSES", HEARTBEAT_MISSES)),
+    session_grace=float(getenv("SESSION_GRACE", SESSION_GRACE)),
+)
+# The results of the games are recorded in a SQLite database, unless its path is set to be empty.
+results_path = getenv("RESULTS_DB", "results.db")
+results = ResultStore(results_path) if results_path else None
+
+game_manager = GameManager(conn_manager, results)
+
+# Types of the messages that the clients can send.
+MESSAGE_TYPES = (
+    "get_open_rooms",
+    "join_room",
+    "leave_room",
+    "create_room",
+    "get_board",
+    "move",
+    "heartbeat",
+    "quick_match",
+    "spectate_room",
+    "resume",
+)
+metrics = Metrics(MESSAGE_TYPES)
+
+# Fields that the messages of each type must have, and their types.
+MESSAGE_FIELDS = {
+    "join_room": {"room_id": int},
+    "get_board": {"room_id": int},
+    "move": {"cell": int},
+    "spectate_room": {"room_id": int},
+    "resume": {"session": str},
+}
+
+rate_limiter = RateLimiter(
+    limits=parse_rate_limits(getenv("RATE_LIMITS", "")),
+    strikes=int(getenv("RATE_LIMIT_STRIKES", RATE_LIMIT_STRIKES)),
+)
+
+
+# Game events of the rooms owned by this worker are queued for the rooms' actors.
+conn_manager.game_event_handler = game_manager.post
+
+
+@app.on_event("startup")
+async def startup():
+    """This function connects to the registry and opens the results database when the server starts."""
+    await conn_manager.start()
+    if results is not None:
+        await results.start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    """This function closes the registry and writes the remaining results and logs when the server shuts down."""
+    game_manager.stop()
+    await conn_manager.stop()
+    if results is not None:
+        await results.close()
+    log_listener.stop()
 
 
 @app.get("/")
@@ -27,80 +130,259 @@ async def root():
     return RedirectResponse(url="/client")
 
 
+@app.get("/metrics")
+async def get_metrics():
+    """This function returns the metrics of this worker in the Prometheus text format."""
+    text = metrics.render(
+        connections=len(conn_manager.conn_ids),
+        open_clients=len(conn_manager.open_clients),
+        rooms=await registry.count_rooms(),
+        games=len(game_manager.games),
+        spectators=sum(len(game["spectators"]) for game in game_manager.games.values()),
+        send_stats=conn_manager.send_stats,
+        lobby_stats=conn_manager.lobby_stats,
+        results_dropped=results.stats["dropped"] if results is not None else 0,
+    )
+    return PlainTextResponse(text, media_type=CONTENT_TYPE)
+
+
+@app.get("/players/{player}/history")
+async def get_player_history(player: str, limit: int = HISTORY_LIMIT):
+    """This function returns the last matches and rounds of the player, and its wins, losses and draws."""
+    if results is None:
+        raise HTTPException(status_code=404, detail="Results are not recorded.")
+
+    return await results.get_history(player, min(max(limit, 1), HISTORY_MAX_LIMIT))
+
+
+@app.get("/admin/trace")
+async def get_trace(token: str = ""):
+    """This function returns the traced messages in the Chrome trace-event format."""
+    if not ADMIN_TOKEN or token != ADMIN_TOKEN:
+        raise HTTPException(status_code=403)
+
+    return tracer.dump()
+
+
+@app.websocket("/shard")
+async def shard_endpoint(peer: WebSocket, token: str = ""):
+    """Endpoint through which the other shards receive the messages published on this shard."""
+    # Only the other shards, which know the shared token, can link to this one.
+    if (
+        not isinstance(registry, ShardRegistry)
+        or not registry.token
+        or not compare_digest(token, registry.token)
+    ):
+        await peer.close(code=1008)
+        return
+
+    await registry.serve_subscriber(peer)
+
+
+def validate_message(message) -> str | None:
+    """This function checks the shape of a decoded message. Returns what is wrong with it, or None if it is valid."""
+    if not isinstance(message, dict):
+        return "Messages must be objects."
+
+    message_type = message.get("type")
+    if not isinstance(message_type, str) or message_type not in MESSAGE_TYPES:
+        return "Unknown message type."
+
+    for field, field_type in MESSAGE_FIELDS.get(message_type, {}).items():
+        value = message.get(field)
+        if not isinstance(value, field_type) or isinstance(value, bool):
+            return f"Field {field} of {message_type} must be of type {field_type.__name__}."
+
+    return None
+
+
+async def handle_message(client: WebSocket, message: dict):
+    """This function handles a message received from the client."""
+    match message["type"]:  # noqa: E999
+        # If message type is "get_open_rooms":
+        case "get_open_rooms":
+            conn_manager.send(
+                client, conn_manager.get_lobby_snapshot(), LOBBY_PRIORITY
+            )
+
+        # If client sent request to join open room:
+        case "join_room":
+            # Get connection IDs of the connected players.
+            player_x, player_o = await conn_manager.join_room(
+                client, message["room_id"]
+            )
+
+            # Keep listening if new player was not connected sucessfully.
+            if (player_x, player_o) == (None, None):
+                return
+
+            logger.info(
+                "Client %s joined room %s",
+                conn_manager.conn_ids[client],
+                message["room_id"],
+            )
+
+            # Start the game on the worker that owns the room.
+            conn_manager.relay_game_event(
+                client,
+                {
+                    "type": "start_game",
+                    "room_id": message["room_id"],
+                    "player_x": player_x,
+                    "player_o": player_o,
+                    "player_ids": conn_manager.get_player_ids(player_x, player_o),
+                },
+            )
+
+        # If the client wants to play against the next player that asks for a quick match.
+        case "quick_match":
+            matched = await conn_manager.quick_match(client)
+            if matched is None:
+                return
+
+            room_id, player_x, player_o = matched
+            logger.info(
+                "Client %s was matched in room %s", conn_manager.conn_ids[client], room_id
+            )
+
+            # The room was created by this worker, so its game is started here.
+            conn_manager.send_game_event(
+                conn_manager.worker_id,
+                {
+                    "type": "start_game",
+                    "room_id": room_id,
+                    "player_x": player_x,
+                    "player_o": player_o,
+                    "player_ids": conn_manager.get_player_ids(player_x, player_o),
+                },
+            )
+
+        # If the client lost its connection and wants its seat back.
+        case "resume":
+            await conn_manager.resume(client, message["session"])
+
+        # If the client wants to watch the game of a room.
+        case "spectate_room":
+            await conn_manager.spectate_room(client, message["room_id"])
+
+        # If the client left the room (or stopped spectating it).
+        case "leave_room":
+            await conn_manager.leave_room(client)
+
+        # If message type is "create_room":
+        case "create_room":
+            await conn_manager.create_room(client)
+
+        # If the client missed a cell update and needs the full board.
+        case "get_board":
+            conn_manager.relay_game_event(
+                client,
+                {
+                    "type": "get_board",
+                    "room_id": message["room_id"],
+                    "conn_id": conn_manager.conn_ids[client],
+                },
+            )
+
+        # Answer to a heartbeat. Receiving any message keeps the client connected.
+        case "heartbeat":
+            pass
+
+        case "move":
+            # Players can only move in their own room, with their own sign.
+            if client not in conn_manager.client_rooms:
+                return
+
+            room_id, sign, _ = conn_manager.client_rooms[client]
+            conn_manager.relay_game_event(
+                client,
+                {
+                    "type": "move",
+                    "room_id": room_id,
+                    "sign": sign,
+                    "cell": message["cell"],
+                },
+            )
+
+
 @app.websocket("/ws")
 async def websocket_endpoint(client: WebSocket):
     """Main endpoint for websocket connection."""
-    print("websocket_endpoint:")
-
     # Accept websocket connection and add connected client to list of open clients.
     await conn_manager.connect(client)
 
     # Listens to all messages from client.
     try:
         while True:
-            message = await client.receive_text()
-            message = loads(message)
+            data = await conn_manager.receive(client)
 
-            print(f"    Received message: {message}")
+            received = perf_counter()
+            try:
+                message = conn_manager.decode(client, data)
+            except (ValueError, TypeError):
+                message = None
+            decoded = perf_counter()
 
-            match message["type"]:  # noqa: E999
-                # If message type is "get_open_rooms":
-                case "get_open_rooms":
-                    open_rooms = await conn_manager.get_open_rooms()
+            logger.debug(
+                "Received message from %s: %s", conn_manager.conn_ids[client], message
+            )
 
-                    await client.send_json(
-                        {
-                            "type": "update_open_rooms",
-                            "open_rooms": open_rooms,
-                        }
-                    )
+            # Invalid messages are counted with the "other" type.
+            error = validate_message(message)
+            if error is None:
+                message_type = message["type"]
+                retry_after = rate_limiter.check(client, message_type)
+            else:
+                message_type = None
+                retry_after = 0
+            metrics.count_message(message_type)
 
-                # If client sent request to join open room:
-                case "join_room":
-                    # Get websocket objects representing connected players.
-                    player_x, player_o = await conn_manager.join_room(
-                        client, message["room_id"]
+            # Drop invalid messages and messages over the client's rate limits,
+            # and disconnect clients that keep sending them.
+            if error is not None or retry_after:
+                if rate_limiter.strike(client):
+                    logger.warning(
+                        "Client %s keeps sending invalid messages or exceeding the rate limits, disconnecting",
+                        conn_manager.conn_ids[client],
                     )
+                    await conn_manager.evict(client, resumable=False)
+                    break
 
-                    # Return from websocket_endpoint function if new player was not connected sucessfully.
-                    if (player_x, player_o) == (None, None):
-                        return
-
-                    # Remove client from open_clients
-                    conn_manager.open_clients.remove(client)
-
-                    print(f"    Client {client} joined a room")
-                    print(f"    open_clients: {conn_manager.open_clients}")
-
-                    # Update open rooms.
-                    await conn_manager.update_open_rooms()
-
-                    await game_manager.start_game(
-                        message["room_id"], player_x, player_o
+                if error is not None:
+                    conn_manager.send(client, {"type": "invalid_message", "message": error})
+                else:
+                    conn_manager.send(
+                        client,
+                        {
+                            "type": "rate_limited",
+                            "message_type": message_type,
+                            "retry_after": round(retry_after, 3),
+                        },
                     )
+                continue
 
-                # If the client left the room.
-                case "leave_room":
-                    await conn_manager.leave_room(client)
-
-                # If message type is "create_room":
-                case "create_room":
-                    await conn_manager.create_room(client)
-
-                    # Remove client from open clients.
-                    conn_manager.open_clients.remove(client)
+            await handle_message(client, message)
+            handled = perf_counter()
+            metrics.observe_handler(message_type, handled - decoded)
 
-                    # Update open rooms
-                    await conn_manager.update_open_rooms()
-
-                case "move":
-                    await game_manager.move(
-                        message["room_id"],
-                        message["sign"],
-                        message["cell"],
-                    )
+            if tracer.sampled():
+                args = {"type": message_type, "conn_id": conn_manager.conn_ids[client]}
+                tracer.record("decode", RECEIVE_TID, received, decoded, args)
+                tracer.record(
+                    metrics.get_label(message_type), RECEIVE_TID, decoded, handled, args
+                )
 
     # If client has disconnected:
     except WebSocketDisconnect:
+        pass
+
+    # The client is disconnected even if handling one of its messages failed.
+    except Exception:
+        logger.exception(
+            "Could not handle a message of client %s", conn_manager.conn_ids.get(client)
+        )
+        await conn_manager.evict(client)
 
+    finally:
         await conn_manager.disconnect(client)
+        rate_limiter.forget(client)
@@ -0,0 +1,196 @@
+"""
+This file contains the metrics of the server, exposed in the Prometheus text format.
+
+Updating a metric only increments numbers in dicts and lists, so they can stay enabled under
+full load. Gauges are not stored at all, but read from the managers when the metrics are scraped.
+"""
+
+from bisect import bisect_left
+
+# Prefix of the names of all metrics.
+PREFIX = "speed_tac_toe_"
+
+# Upper bounds in seconds of the buckets of the handler latency histogram.
+LATENCY_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+)
+
+# Content type of the Prometheus text format.
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Histogram:
+    """Histogram with the same buckets for every value of its label."""
+
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+
+        # Number of observations in every bucket (not cumulative, with a last one for +Inf)
+        # and sum of the observed values, by label value.
+        self.counts = {}
+        self.sums = {}
+
+    def observe(self, label: str, value: float):
+        """Records the value."""
+        counts = self.counts.get(label)
+        if counts is None:
+            counts = self.counts[label] = [0] * (len(self.buckets) + 1)
+            self.sums[label] = 0.0
+
+        counts[bisect_left(self.buckets, value)] += 1
+        self.sums[label] += value
+
+    def samples(self, label_name: str) -> list[tuple[str, dict, float]]:
+        """Gets the samples of the histogram, with cumulative bucket counts."""
+        samples = []
+        for label, counts in self.counts.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                samples.append(
+                    ("_bucket", {label_name: label, "le": bound}, cumulative)
+                )
+            samples.append(("_sum", {label_name: label}, self.sums[label]))
+            samples.append(("_count", {label_name: label}, cumulative))
+        return samples
+
+
+def format_metric(name: str, kind: str, description: str, samples) -> str:
+    """
+    Formats the metric in the Prometheus text format.
+
+    The samples are (name suffix, labels, value) tuples, or (labels, value) tuples for metrics
+    without suffixes.
+    """
+    lines = [f"# HELP {PREFIX}{name} {description}", f"# TYPE {PREFIX}{name} {kind}"]
+    for sample in samples:
+        if len(sample) == 2:
+            sample = ("", *sample)
+        suffix, labels, value = sample
+
+        if labels:
+            label_text = ",".join(f'{key}="{label}"' for key, label in labels.items())
+            lines.append(f"{PREFIX}{name}{suffix}{{{label_text}}} {value}")
+        else:
+            lines.append(f"{PREFIX}{name}{suffix} {value}")
+    return "\n".join(lines)
+
+
+class Metrics:
+    """This class collects the counters and histograms of the server."""
+
+    def __init__(self, message_types: tuple[str, ...]):
+        # Messages of other types are counted as "other", so that clients cannot add labels.
+        self.message_types = set(message_types)
+
+        self.messages_received = dict.fromkeys(message_types, 0)
+        self.messages_received["other"] = 0
+        self.handler_latency = Histogram()
+
+    def get_label(self, message_type: str) -> str:
+        """Gets the label of the message type."""
+        if message_type in self.message_types:
+            return message_type
+        return "other"
+
+    def count_message(self, message_type: str):
+        """Counts the received message."""
+        self.messages_received[self.get_label(message_type)] += 1
+
+    def observe_handler(self, message_type: str, seconds: float):
+        """Records the time it took to handle the message."""
+        self.handler_latency.observe(self.get_label(message_type), seconds)
+
+    def render(
+        self,
+        connections: int,
+        open_clients: int,
+        rooms: dict[str, int],
+        games: int,
+        spectators: int,
+        send_stats: dict[str, int],
+        lobby_stats: dict[str, int],
+        results_dropped: int,
+    ) -> str:
+        """Formats all metrics, using the given current values of the gauges."""
+        metrics = [
+            format_metric(
+                "connections", "gauge", "Connected clients.", [({}, connections)]
+            ),
+            format_metric(
+                "open_clients",
+                "gauge",
+                "Connected clients that are not in a room.",
+                [({}, open_clients)],
+            ),
+            format_metric(
+                "rooms",
+                "gauge",
+                "Rooms by state.",
+                [({"state": state}, count) for state, count in rooms.items()],
+            ),
+            format_metric(
+                "games_in_progress", "gauge", "Games run by this worker.", [({}, games)]
+            ),
+            format_metric(
+                "spectators",
+                "gauge",
+                "Spectators of the games run by this worker.",
+                [({}, spectators)],
+            ),
+            format_metric(
+                "messages_received_total",
+                "counter",
+                "Messages received from the clients by type.",
+                [
+                    ({"type": message_type}, count)
+                    for message_type, count in self.messages_received.items()
+                ],
+            ),
+            format_metric(
+                "messages_sent_total",
+                "counter",
+                "Messages queued for the clients by outcome (sent, timed_out, failed or dropped).",
+                [
+                    ({"outcome": outcome}, count)
+                    for outcome, count in send_stats.items()
+                ],
+            ),
+            format_metric(
+                "lobby_notifications_total",
+                "counter",
+                "Changes to the open rooms that a lobby update was scheduled for.",
+                [({}, lobby_stats["notifications"])],
+            ),
+            format_metric(
+                "lobby_flushes_total",
+                "counter",
+                "Lobby updates sent with the changes collected during the flush interval.",
+                [({}, lobby_stats["flushes"])],
+            ),
+            format_metric(
+                "results_dropped_total",
+                "counter",
+                "Results of rounds and matches dropped because too many were waiting to be written.",
+                [({}, results_dropped)],
+            ),
+            format_metric(
+                "handler_latency_seconds",
+                "histogram",
+                "Time taken to handle a received message by type.",
+                self.handler_latency.samples("type"),
+            ),
+        ]
+        return "\n".join(metrics) + "\n"
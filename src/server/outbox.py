@@ -0,0 +1,161 @@
+"""This file contains definition of Outbox class."""
+
+import asyncio
+import logging
+from itertools import count
+from time import monotonic, perf_counter
+
+from fastapi import WebSocket
+
+from server.codec import DEFAULT_CODEC, SharedMessage
+from server.tracing import SEND_TID, tracer
+
+logger = logging.getLogger(__name__)
+
+# Priorities of outgoing messages. Messages with lower values are sent first.
+GAME_PRIORITY = 0
+LOBBY_PRIORITY = 1
+
+# Maximum number of messages waiting to be sent to a single client.
+OUTBOX_SIZE = 64
+
+# Maximum time in seconds that a single message is given to be sent to the client.
+SEND_TIMEOUT = 1.0
+
+# Time in seconds that the outbox can stay full before the client is disconnected.
+SLOW_CONSUMER_TIMEOUT = 5.0
+
+
+class Outbox:
+    """
+    This class handles outgoing messages of a single client.
+
+    Messages are put in a bounded priority queue and sent by a separate writer task,
+    so that the code sending them never waits for the client's network connection.
+    Clients that do not keep up with their messages are disconnected.
+    """
+
+    def __init__(
+        self,
+        client: WebSocket,
+        stats: dict,
+        codec=DEFAULT_CODEC,
+        name: str | None = None,
+    ):
+        self.client = client
+
+        # Name of the client in the logs, such as its connection ID.
+        self.name = name if name is not None else repr(client)
+
+        # Codec negotiated with the client, used to encode all outgoing messages.
+        self.codec = codec
+
+        # Shared counters of all send outcomes ("sent", "timed_out", "failed" and "dropped").
+        self.stats = stats
+
+        # Items are (priority, sequence number, message), so that messages
+        # with the same priority are sent in the order they were queued.
+        self.queue = asyncio.PriorityQueue(OUTBOX_SIZE)
+        self.sequence = count()
+
+        # Time at which the queue was first found full, or None if it is not full.
+        self.full_since = None
+
+        self.closed = False
+        self.writer_task = asyncio.create_task(self.write())
+
+    def send(
+        self, message: dict | SharedMessage, priority: int = GAME_PRIORITY
+    ) -> bool:
+        """
+        Queues the message to be sent to the client.
+
+        Messages sent to many clients can be wrapped in a SharedMessage, so that they are only encoded once.
+
+        Returns False if the message was dropped, because the outbox is closed or full.
+        """
+        if self.closed:
+            return False
+
+        try:
+            self.queue.put_nowait((priority, next(self.sequence), message))
+        except asyncio.QueueFull:
+            self.stats["dropped"] += 1
+
+            now = monotonic()
+            if self.full_since is None:
+                self.full_since = now
+            elif now - self.full_since > SLOW_CONSUMER_TIMEOUT:
+                logger.warning("Client %s is too slow, disconnecting", self.name)
+                self.evict()
+
+            return False
+
+        return True
+
+    async def write(self):
+        """This function sends the queued messages to the client until the outbox is closed."""
+        while True:
+            priority, _, message = await self.queue.get()
+
+            if not self.queue.full():
+                self.full_since = None
+
+            traced = tracer.sampled()
+            if traced:
+                started = perf_counter()
+
+            if isinstance(message, SharedMessage):
+                data = message.encode(self.codec)
+                message = message.message
+            else:
+                data = self.codec.encode(message)
+
+            if traced:
+                encoded = perf_counter()
+            if self.codec.binary:
+                send = self.client.send_bytes(data)
+            else:
+                send = self.client.send_text(data)
+
+            try:
+                await asyncio.wait_for(send, SEND_TIMEOUT)
+            except asyncio.TimeoutError:
+                self.stats["timed_out"] += 1
+                logger.warning(
+                    "Sending to client %s timed out, disconnecting", self.name
+                )
+                self.evict()
+                return
+            except Exception as error:
+                # The connection is lost, so the receive loop will disconnect the client.
+                self.stats["failed"] += 1
+                logger.info("Could not send to client %s: %r", self.name, error)
+                self.closed = True
+                return
+
+            self.stats["sent"] += 1
+
+            if traced:
+                args = {"type": message.get("type"), "priority": priority}
+                tracer.record("encode", SEND_TID, started, encoded, args)
+                tracer.record("send", SEND_TID, encoded, perf_counter(), args)
+
+    def evict(self):
+        """This function stops sending messages and closes the connection to the client."""
+        self.close()
+        self.close_task = asyncio.create_task(self.close_client())
+
+    async def close_client(self):
+        """This function closes the websocket, which makes the receive loop disconnect the client."""
+        try:
+            await asyncio.wait_for(self.client.close(code=1008), SEND_TIMEOUT)
+        except Exception as error:
+            logger.info("Could not close client %s: %r", self.name, error)
+
+    def close(self):
+        """This function stops the writer task and drops all messages that were not sent."""
+        self.closed = True
+
+        if self.writer_task is not asyncio.current_task():
+            self.writer_task.cancel()
@@ -0,0 +1,98 @@
+"""This file contains the rate limiter of the messages received from the clients."""
+
+from time import monotonic
+
+from fastapi import WebSocket
+
+# Rate (tokens per second) and burst (maximum number of tokens) of every message type.
+# Messages of other types share the "other" bucket.
+RATE_LIMITS = {
+    "move": (30.0, 30.0),
+    "create_room": (1.0, 3.0),
+    "join_room": (2.0, 5.0),
+    "quick_match": (1.0, 3.0),
+    "spectate_room": (1.0, 3.0),
+    "resume": (1.0, 3.0),
+    "leave_room": (1.0, 3.0),
+    "get_open_rooms": (2.0, 5.0),
+    "get_board": (5.0, 10.0),
+    "heartbeat": (1.0, 5.0),
+    "other": (5.0, 10.0),
+}
+
+# Number of messages over the limits that a client can send in a burst before it is disconnected.
+# Clients get back one strike per second.
+RATE_LIMIT_STRIKES = 20
+
+
+def parse_rate_limits(text: str) -> dict[str, tuple[float, float]]:
+    """Parses rate limits in the format `move=30:30,create_room=1:3` (type=rate:burst)."""
+    limits = {}
+    for item in text.split(","):
+        if not item.strip():
+            continue
+        message_type, limit = item.split("=")
+        rate, burst = limit.split(":")
+        limits[message_type.strip()] = (float(rate), float(burst))
+    return limits
+
+
+class RateLimiter:
+    """
+    This class limits the rate of the messages of every client with token buckets.
+
+    Every client has a bucket per message type, which is refilled when it is used,
+    so checking a message takes constant time and idle clients cost nothing.
+    """
+
+    def __init__(
+        self,
+        limits: dict[str, tuple[float, float]] = RATE_LIMITS,
+        strikes: int = RATE_LIMIT_STRIKES,
+    ):
+        self.limits = {**RATE_LIMITS, **limits}
+        self.strikes = strikes
+
+        # Buckets of every client by message type, as [tokens, time of the last update] lists.
+        self.buckets = {}
+
+    def take(self, bucket: list, rate: float, burst: float) -> float:
+        """Takes a token from the bucket. Returns 0 if it had one, otherwise the seconds until it will."""
+        now = monotonic()
+        tokens = min(burst, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+
+        if tokens < 1:
+            bucket[0] = tokens
+            return (1 - tokens) / rate
+
+        bucket[0] = tokens - 1
+        return 0.0
+
+    def get_bucket(self, client: WebSocket, key: str, burst: float) -> list:
+        """Gets the client's bucket, creating it full if it does not exist yet."""
+        client_buckets = self.buckets.get(client)
+        if client_buckets is None:
+            client_buckets = self.buckets[client] = {}
+
+        bucket = client_buckets.get(key)
+        if bucket is None:
+            bucket = client_buckets[key] = [burst, monotonic()]
+        return bucket
+
+    def check(self, client: WebSocket, message_type: str) -> float:
+        """Counts the message. Returns 0 if it is allowed, otherwise the seconds until the client can send it."""
+        if message_type not in self.limits:
+            message_type = "other"
+
+        rate, burst = self.limits[message_type]
+        return self.take(self.get_bucket(client, message_type, burst), rate, burst)
+
+    def strike(self, client: WebSocket) -> bool:
+        """Counts a message over the limits. Returns True if the client has run out of strikes."""
+        bucket = self.get_bucket(client, "strikes", self.strikes)
+        return self.take(bucket, 1.0, self.strikes) > 0
+
+    def forget(self, client: WebSocket):
+        """Removes the buckets of the disconnected client."""
+        self.buckets.pop(client, None)
@@ -0,0 +1,659 @@
+"""
+This file contains the registries that hold the state shared by all server workers.
+
+The registry stores the seats of every room and the set of open rooms, and relays
+messages between workers with publish/subscribe. Seats are identified by connection IDs,
+since the websockets themselves only exist in the worker that accepted them.
+"""
+
+import asyncio
+import json
+import logging
+from collections import deque
+from typing import Callable
+from urllib.parse import urlencode, urlsplit
+
+import websockets
+from fastapi import WebSocket, WebSocketDisconnect
+
+from server.outbox import Outbox
+
+logger = logging.getLogger(__name__)
+
+# Channel on which the changes to the open rooms are published.
+LOBBY_CHANNEL = "lobby"
+
+# Time in seconds to wait before reconnecting to a shard whose link was lost.
+SHARD_RECONNECT_DELAY = 1.0
+
+# Time in seconds to wait before reconnecting to Redis after the connection was lost.
+REDIS_RECONNECT_DELAY = 1.0
+
+# Script that creates a room with the player in the "x" seat, unless the room already exists.
+# Its keys are the room, the room counter, the set of rooms and the open rooms, and its
+# arguments are the room ID, the owner worker and the connection ID of the player.
+CREATE_ROOM_SCRIPT = """
+if redis.call("EXISTS", KEYS[1]) == 1 then
+    return 0
+end
+local created = redis.call("INCR", KEYS[2])
+redis.call("HSET", KEYS[1], "owner", ARGV[2], "x", ARGV[3], "created", created)
+redis.call("SADD", KEYS[3], ARGV[1])
+redis.call("ZADD", KEYS[4], created, ARGV[1])
+return 1
+"""
+
+
+def worker_channel(worker_id: str) -> str:
+    """Gets the channel on which the messages for the given worker are published."""
+    return f"worker:{worker_id}"
+
+
+class Registry:
+    """
+    Interface of the shared room registry.
+
+    Rooms are returned as dicts with the connection IDs of the "x" and "o" players
+    (None for free seats) and the ID of the "owner" worker that runs the room's game.
+    """
+
+    # Coroutine function called once the registry has reconnected after losing the messages
+    # published in the meantime, so that the state built from them can be reloaded.
+    resync_handler = None
+
+    async def connect(self):
+        """Connects to the registry."""
+
+    async def close(self):
+        """Closes the connection to the registry."""
+
+    async def create_room(self, room_id: int, owner: str, conn_id: str) -> bool:
+        """Creates the room with the player in the "x" seat. Returns False if the room already exists."""
+        raise NotImplementedError
+
+    async def get_room(self, room_id: int) -> dict | None:
+        """Gets the room, or None if it does not exist."""
+        raise NotImplementedError
+
+    async def join_room(
+        self, room_id: int, conn_id: str
+    ) -> tuple[str | None, dict | None]:
+        """
+        Seats the player in the first free seat of the room.
+
+        Returns the sign of the seat and the room, or None and the room (None if it does not exist)
+        if the player could not be seated.
+        """
+        raise NotImplementedError
+
+    async def leave_room(self, room_id: int, sign: str) -> dict | None:
+        """Frees the seat. Returns the room, or None if it was deleted because it became empty."""
+        raise NotImplementedError
+
+    async def get_open_rooms(self) -> list[int]:
+        """Gets the IDs of all rooms that have only one connected player, in the order they were created."""
+        raise NotImplementedError
+
+    async def count_rooms(self) -> dict[str, int]:
+        """Gets the number of "open" rooms with one player and of "full" rooms with two players."""
+        raise NotImplementedError
+
+    def publish(self, channel: str, message: dict):
+        """Publishes the message on the channel without waiting for it to be delivered."""
+        raise NotImplementedError
+
+    async def subscribe(self, channel: str, handler: Callable[[dict], None]):
+        """Calls the handler with every message published on the channel."""
+        raise NotImplementedError
+
+    def make_room_id(self, number: int) -> int:
+        """Gets the ID of a new room from a random number."""
+        return number
+
+    def get_room_shard_url(self, room_id: int) -> str | None:
+        """Gets the URL of the shard that owns the room, or None if the room belongs to this server."""
+        return None
+
+
+class InMemoryRegistry(Registry):
+    """Registry kept in the memory of a single worker. Used when the server runs with one worker."""
+
+    def __init__(self):
+        self.rooms = {}
+
+        # Insertion-ordered set of the open room IDs.
+        self.open_rooms = {}
+
+        self.handlers = {}
+
+    async def create_room(self, room_id: int, owner: str, conn_id: str) -> bool:
+        """Creates the room with the player in the "x" seat. Returns False if the room already exists."""
+        if room_id in self.rooms:
+            return False
+
+        self.rooms[room_id] = {"x": conn_id, "o": None, "owner": owner}
+        self.open_rooms[room_id] = None
+        return True
+
+    async def get_room(self, room_id: int) -> dict | None:
+        """Gets the room, or None if it does not exist."""
+        return self.rooms.get(room_id)
+
+    async def join_room(
+        self, room_id: int, conn_id: str
+    ) -> tuple[str | None, dict | None]:
+        """Seats the player in the first free seat of the room."""
+        room = self.rooms.get(room_id)
+        if room is None:
+            return None, None
+
+        if room["x"] is None:
+            sign = "x"
+        elif room["o"] is None:
+            sign = "o"
+        else:
+            return None, room
+
+        room[sign] = conn_id
+        self.open_rooms.pop(room_id, None)
+        return sign, room
+
+    async def leave_room(self, room_id: int, sign: str) -> dict | None:
+        """Frees the seat. Returns the room, or None if it was deleted because it became empty."""
+        room = self.rooms.get(room_id)
+        if room is None:
+            return None
+
+        room[sign] = None
+        if room["x"] is None and room["o"] is None:
+            del self.rooms[room_id]
+            self.open_rooms.pop(room_id, None)
+            return None
+
+        self.open_rooms[room_id] = None
+        return room
+
+    async def get_open_rooms(self) -> list[int]:
+        """Gets the IDs of all open rooms."""
+        return list(self.open_rooms)
+
+    async def count_rooms(self) -> dict[str, int]:
+        """Gets the number of open and full rooms."""
+        return {
+            "open": len(self.open_rooms),
+            "full": len(self.rooms) - len(self.open_rooms),
+        }
+
+    def publish(self, channel: str, message: dict):
+        """Calls the handlers of the channel right away."""
+        for handler in self.handlers.get(channel, ()):
+            handler(message)
+
+    async def subscribe(self, channel: str, handler: Callable[[dict], None]):
+        """Calls the handler with every message published on the channel."""
+        self.handlers.setdefault(channel, []).append(handler)
+
+
+class RedisError(Exception):
+    """Error reply sent by the Redis server."""
+
+
+class RedisConnection:
+    """
+    Minimal client for the Redis serialisation protocol (RESP).
+
+    Commands are pipelined: each one is written right away and its reply is matched
+    to it by a reader task, in the order the commands were sent. Once the connection
+    is lost, the waiting and all later commands fail with a ConnectionError.
+    """
+
+    def __init__(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        on_lost: Callable[[], None] | None = None,
+    ):
+        self.reader = reader
+        self.writer = writer
+        self.pending = deque()
+        self.push_handler = None
+        self.on_lost = on_lost
+        self.closed = False
+        self.reader_task = asyncio.create_task(self.read_replies())
+
+    @classmethod
+    async def open(
+        cls, url: str, on_lost: Callable[[], None] | None = None
+    ) -> "RedisConnection":
+        """
+        Opens a connection to the Redis server at the URL, e.g. `redis://localhost:6379/0`.
+
+        The function `on_lost` is called if the connection is lost.
+        """
+        parts = urlsplit(url)
+        reader, writer = await asyncio.open_connection(
+            parts.hostname or "localhost", parts.port or 6379
+        )
+        connection = cls(reader, writer, on_lost)
+
+        if parts.password:
+            await connection.execute("AUTH", parts.password)
+        if parts.path.strip("/"):
+            await connection.execute("SELECT", parts.path.strip("/"))
+
+        return connection
+
+    def send_command(self, *args) -> asyncio.Future:
+        """Writes the command and returns the future of its reply."""
+        if self.closed:
+            raise ConnectionError("Connection to Redis was closed.")
+
+        data = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode()
+            data.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+        self.writer.write(b"".join(data))
+
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append(future)
+        return future
+
+    async def execute(self, *args):
+        """Sends the command and waits for its reply."""
+        return await self.send_command(*args)
+
+    async def read_reply(self):
+        """Reads a single reply from the server."""
+        line = await self.reader.readline()
+        if not line:
+            raise ConnectionError("Connection to Redis was closed.")
+
+        prefix, rest = line[:1], line[1:-2]
+        match prefix:  # noqa: E999
+            case b"+":
+                return rest.decode()
+            case b"-":
+                return RedisError(rest.decode())
+            case b":":
+                return int(rest)
+            case b"$":
+                if int(rest) == -1:
+                    return None
+                return (await self.reader.readexactly(int(rest) + 2))[:-2]
+            case b"*":
+                if int(rest) == -1:
+                    return None
+                return [await self.read_reply() for _ in range(int(rest))]
+        raise RedisError(f"Unknown reply: {line!r}")
+
+    async def read_replies(self):
+        """This function resolves the futures of the sent commands and handles published messages."""
+        try:
+            while True:
+                reply = await self.read_reply()
+
+                # Messages published on subscribed channels are not replies to a command.
+                if (
+                    self.push_handler is not None
+                    and isinstance(reply, list)
+                    and reply[0] == b"message"
+                ):
+                    try:
+                        self.push_handler(reply[1].decode(), reply[2])
+                    except Exception:
+                        logger.exception("Could not handle a message published on %s", reply[1])
+                    continue
+
+                # The futures of cancelled commands are done already.
+                future = self.pending.popleft()
+                if future.done():
+                    continue
+
+                if isinstance(reply, RedisError):
+                    future.set_exception(reply)
+                else:
+                    future.set_result(reply)
+        except (ConnectionError, asyncio.IncompleteReadError, RedisError) as error:
+            logger.error("Lost connection to Redis: %r", error)
+            self.lose(ConnectionError(f"Lost connection to Redis: {error!r}"))
+
+    def lose(self, error: ConnectionError):
+        """This function fails the waiting commands with the error, and tells the owner of the connection."""
+        self.closed = True
+        self.writer.close()
+
+        while self.pending:
+            future = self.pending.popleft()
+            if not future.done():
+                future.set_exception(error)
+
+        if self.on_lost is not None:
+            self.on_lost()
+
+    async def close(self):
+        """Closes the connection."""
+        self.closed = True
+        self.reader_task.cancel()
+        self.writer.close()
+
+
+class RedisRegistry(Registry):
+    """
+    Registry stored in a Redis server (or anything that speaks its protocol), shared by all workers.
+
+    Each room is a hash with the "owner", "x" and "o" fields and its creation number, the IDs of all rooms
+    are a set, and the open rooms are a sorted set scored by creation number. Rooms are created by a script,
+    so the "x" seat is taken along with the room, and the other seats are claimed with HSETNX, so two players
+    can never take the same seat.
+
+    If a connection to Redis is lost, the commands fail with a ConnectionError until it is reopened.
+    Messages published while the subscriber connection is lost are missed.
+    """
+
+    def __init__(self, url: str, prefix: str = "speed-tac-toe:"):
+        self.url = url
+        self.prefix = prefix
+        self.handlers = {}
+        self.reconnect_task = None
+
+    async def connect(self):
+        """Opens one connection for commands and one for subscriptions."""
+        self.commands = await self.open_commands()
+        self.subscriber = await self.open_subscriber()
+
+    async def open_commands(self) -> RedisConnection:
+        """This function opens the connection for commands."""
+        return await RedisConnection.open(self.url, self.on_connection_lost)
+
+    async def open_subscriber(self) -> RedisConnection:
+        """This function opens the connection for subscriptions, subscribed to all channels that have handlers."""
+        subscriber = await RedisConnection.open(self.url, self.on_connection_lost)
+        subscriber.push_handler = self.on_message
+        for channel in self.handlers:
+            await subscriber.execute("SUBSCRIBE", channel)
+        return subscriber
+
+    def on_connection_lost(self):
+        """This function starts reconnecting once a connection to Redis is lost."""
+        if self.reconnect_task is None:
+            self.reconnect_task = asyncio.create_task(self.reconnect())
+
+    async def reconnect(self):
+        """This function reopens the lost connections, retrying until Redis is reachable again."""
+        resubscribed = False
+        while True:
+            await asyncio.sleep(REDIS_RECONNECT_DELAY)
+
+            try:
+                if self.commands.closed:
+                    self.commands = await self.open_commands()
+                if self.subscriber.closed:
+                    self.subscriber = await self.open_subscriber()
+                    resubscribed = True
+
+                # Messages published while the subscriber was disconnected were missed.
+                if resubscribed and self.resync_handler is not None:
+                    await self.resync_handler()
+            except (OSError, RedisError) as error:
+                logger.warning("Could not reconnect to Redis: %r", error)
+                continue
+
+            logger.info("Reconnected to Redis")
+            self.reconnect_task = None
+            return
+
+    async def close(self):
+        """Closes both connections."""
+        if self.reconnect_task is not None:
+            self.reconnect_task.cancel()
+        await self.commands.close()
+        await self.subscriber.close()
+
+    def key(self, *parts) -> str:
+        """Gets the key with the registry prefix."""
+        return self.prefix + ":".join(str(part) for part in parts)
+
+    async def create_room(self, room_id: int, owner: str, conn_id: str) -> bool:
+        """Creates the room with the player in the "x" seat. Returns False if the room already exists."""
+        created = await self.commands.execute(
+            "EVAL",
+            CREATE_ROOM_SCRIPT,
+            4,
+            self.key("room", room_id),
+            self.key("room_count"),
+            self.key("rooms"),
+            self.key("open_rooms"),
+            room_id,
+            owner,
+            conn_id,
+        )
+        return created == 1
+
+    async def get_room(self, room_id: int) -> dict | None:
+        """Gets the room, or None if it does not exist."""
+        owner, x, o, created = await self.commands.execute(
+            "HMGET", self.key("room", room_id), "owner", "x", "o", "created"
+        )
+        if owner is None:
+            return None
+
+        return {
+            "x": x and x.decode(),
+            "o": o and o.decode(),
+            "owner": owner.decode(),
+            "created": created,
+        }
+
+    async def join_room(
+        self, room_id: int, conn_id: str
+    ) -> tuple[str | None, dict | None]:
+        """Seats the player in the first free seat of the room."""
+        room = await self.get_room(room_id)
+        if room is None:
+            return None, None
+
+        room_key = self.key("room", room_id)
+        for sign in ("x", "o"):
+            if room[sign] is None and await self.commands.execute(
+                "HSETNX", room_key, sign, conn_id
+            ):
+                break
+        else:
+            return None, room
+
+        room = await self.get_room(room_id)
+        if room is None:
+            # The room was deleted before the seat was claimed.
+            await self.commands.execute("DEL", room_key)
+            await self.commands.execute("SREM", self.key("rooms"), room_id)
+            return None, None
+
+        if room["x"] is not None and room["o"] is not None:
+            await self.commands.execute("ZREM", self.key("open_rooms"), room_id)
+        return sign, room
+
+    async def leave_room(self, room_id: int, sign: str) -> dict | None:
+        """Frees the seat. Returns the room, or None if it was deleted because it became empty."""
+        room_key = self.key("room", room_id)
+        await self.commands.execute("HDEL", room_key, sign)
+
+        room = await self.get_room(room_id)
+        if room is None:
+            return None
+
+        if room["x"] is None and room["o"] is None:
+            await self.commands.execute("DEL", room_key)
+            await self.commands.execute("SREM", self.key("rooms"), room_id)
+            await self.commands.execute("ZREM", self.key("open_rooms"), room_id)
+            return None
+
+        # Reopened rooms keep their place in the lobby.
+        await self.commands.execute(
+            "ZADD", self.key("open_rooms"), room["created"], room_id
+        )
+        return room
+
+    async def get_open_rooms(self) -> list[int]:
+        """Gets the IDs of all open rooms."""
+        room_ids = await self.commands.execute("ZRANGE", self.key("open_rooms"), 0, -1)
+        return [int(room_id) for room_id in room_ids]
+
+    async def count_rooms(self) -> dict[str, int]:
+        """Gets the number of open and full rooms of all workers."""
+        rooms, open_rooms = await asyncio.gather(
+            self.commands.execute("SCARD", self.key("rooms")),
+            self.commands.execute("ZCARD", self.key("open_rooms")),
+        )
+        return {"open": open_rooms, "full": rooms - open_rooms}
+
+    def publish(self, channel: str, message: dict):
+        """Publishes the message without waiting for the reply, or drops it while Redis is unreachable."""
+        if self.commands.closed:
+            logger.warning("Dropping message on %s, Redis is unreachable", channel)
+            return
+
+        self.commands.send_command("PUBLISH", self.key(channel), json.dumps(message))
+
+    async def subscribe(self, channel: str, handler: Callable[[dict], None]):
+        """Calls the handler with every message published on the channel."""
+        self.handlers.setdefault(self.key(channel), []).append(handler)
+        await self.subscriber.execute("SUBSCRIBE", self.key(channel))
+
+    def on_message(self, channel: str, data: bytes):
+        """This function passes a message published on a subscribed channel to its handlers."""
+        message = json.loads(data)
+        for handler in self.handlers.get(channel, ()):
+            handler(message)
+
+
+class ShardRegistry(InMemoryRegistry):
+    """
+    Registry of one shard of a server that runs as several independent processes.
+
+    Every room lives in the memory of the shard that created it, and its ID encodes that shard
+    (`room_id % shard count`), so players joining it are sent to the shard and its game never
+    leaves one process. Only the lobby is shared: each shard subscribes to every other shard
+    and receives the messages published there, including the changes to their open rooms.
+    """
+
+    def __init__(self, shard_index: int, shard_urls: list[str], token: str):
+        super().__init__()
+        self.shard_index = shard_index
+
+        # Address ("host:port") of every shard, including this one.
+        self.shard_urls = shard_urls
+
+        # Secret shared by the shards, which they send when they link to each other.
+        self.token = token
+
+        # Outboxes of the shards subscribed to the messages published on this shard.
+        self.subscribers = set()
+        self.send_stats = {
+            "sent": 0,
+            "timed_out": 0,
+            "failed": 0,
+            "dropped": 0,
+        }
+
+        # Open rooms of every other shard, as last received from it.
+        self.shard_rooms = {
+            index: {} for index in range(len(shard_urls)) if index != shard_index
+        }
+        self.link_tasks = []
+
+    async def connect(self):
+        """Starts subscribing to all other shards."""
+        self.link_tasks = [
+            asyncio.create_task(self.link(index, self.shard_urls[index]))
+            for index in self.shard_rooms
+        ]
+
+    async def close(self):
+        """Stops the links to the other shards."""
+        for task in self.link_tasks:
+            task.cancel()
+        for outbox in self.subscribers:
+            outbox.close()
+
+    def make_room_id(self, number: int) -> int:
+        """Gets the ID of a new room, which encodes this shard."""
+        return number * len(self.shard_urls) + self.shard_index
+
+    def get_room_shard_url(self, room_id: int) -> str | None:
+        """Gets the URL of the shard that owns the room, or None if it belongs to this shard."""
+        shard_index = room_id % len(self.shard_urls)
+        if shard_index == self.shard_index:
+            return None
+        return self.shard_urls[shard_index]
+
+    async def get_open_rooms(self) -> list[int]:
+        """Gets the IDs of the open rooms of this shard. The other shards send theirs once they are linked."""
+        return list(self.open_rooms)
+
+    def publish(self, channel: str, message: dict):
+        """
+        Calls the handlers of the channel and sends the message to all subscribed shards.
+
+        A shard that misses a message would keep a wrong lobby, so if the message cannot be queued
+        for it, its link is closed. The shard then links again and starts over from the open rooms.
+        """
+        super().publish(channel, message)
+
+        for outbox in list(self.subscribers):
+            if not outbox.send({"channel": channel, "message": message}):
+                logger.warning("Dropped a message to %s, closing it", outbox.name)
+                self.subscribers.discard(outbox)
+                outbox.evict()
+
+    async def serve_subscriber(self, peer: WebSocket):
+        """This function sends the messages published on this shard to another shard until it disconnects."""
+        await peer.accept()
+        outbox = Outbox(peer, self.send_stats, name=f"shard link from {peer.client.host}:{peer.client.port}")
+
+        # Start with the current open rooms, followed by their changes.
+        outbox.send(
+            {"channel": LOBBY_CHANNEL, "message": {"added": list(self.open_rooms)}}
+        )
+        self.subscribers.add(outbox)
+
+        try:
+            while True:
+                await peer.receive_text()
+        except WebSocketDisconnect:
+            pass
+        finally:
+            self.subscribers.discard(outbox)
+            outbox.close()
+
+    async def link(self, shard_index: int, url: str):
+        """This function receives the messages published on the other shard, reconnecting whenever the link is lost."""
+        rooms = self.shard_rooms[shard_index]
+
+        while True:
+            try:
+                async with websockets.connect(f"ws://{url}/shard?{urlencode({'token': self.token})}") as peer:
+                    logger.info("Linked to shard %d at %s", shard_index, url)
+
+                    async for data in peer:
+                        envelope = json.loads(data)
+                        channel, message = envelope["channel"], envelope["message"]
+
+                        if channel == LOBBY_CHANNEL:
+                            rooms.update(dict.fromkeys(message.get("added", ())))
+                            for room_id in message.get("removed", ()):
+                                rooms.pop(room_id, None)
+
+                        # Messages from other shards are not passed on, as every shard is linked to all of them.
+                        super().publish(channel, message)
+            except (OSError, websockets.ConnectionClosed, websockets.InvalidHandshake) as error:
+                logger.warning(
+                    "Lost link to shard %d at %s: %r", shard_index, url, error
+                )
+
+            # The rooms of the shard cannot be joined until it is reachable again.
+            if rooms:
+                super().publish(LOBBY_CHANNEL, {"removed": list(rooms)})
+                rooms.clear()
+
+            await asyncio.sleep(SHARD_RECONNECT_DELAY)
@@ -0,0 +1,285 @@
+"""
+This file contains the store of the results of the finished rounds and matches.
+
+The results are kept in a SQLite database. Recording a result only appends it to a list,
+and a writer task inserts the collected results in batches, once enough of them are waiting
+or the flush interval has passed. The database is only ever used from a single thread,
+so the event loop never waits for the disk.
+"""
+
+import asyncio
+import logging
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+logger = logging.getLogger(__name__)
+
+# Default number of results that are written in a single batch, and time in seconds after which
+# the waiting results are written even if there are fewer of them.
+RESULTS_BATCH_SIZE = 500
+RESULTS_FLUSH_INTERVAL = 1.0
+
+# Maximum number of results waiting to be written. Results over it are dropped, e.g. if the disk is full.
+RESULTS_MAX_PENDING = 100000
+
+# Default and maximum number of matches and rounds returned for a player's history.
+HISTORY_LIMIT = 20
+HISTORY_MAX_LIMIT = 100
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS rounds (
+    id INTEGER PRIMARY KEY,
+    room_id INTEGER NOT NULL,
+    round INTEGER NOT NULL,
+    -- IDs of the players, or NULL for players that did not give one.
+    player_x TEXT,
+    player_o TEXT,
+    -- Sign of the winner, or NULL if the round was a draw.
+    winner TEXT,
+    finished_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS rounds_player_x ON rounds (player_x, finished_at);
+CREATE INDEX IF NOT EXISTS rounds_player_o ON rounds (player_o, finished_at);
+
+CREATE TABLE IF NOT EXISTS matches (
+    id INTEGER PRIMARY KEY,
+    room_id INTEGER NOT NULL,
+    player_x TEXT,
+    player_o TEXT,
+    x_wins INTEGER NOT NULL,
+    o_wins INTEGER NOT NULL,
+    rounds INTEGER NOT NULL,
+    started_at REAL NOT NULL,
+    finished_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS matches_player_x ON matches (player_x, finished_at);
+CREATE INDEX IF NOT EXISTS matches_player_o ON matches (player_o, finished_at);
+"""
+
+
+class ResultStore:
+    """
+    This class writes the results of the games to a SQLite database in batches.
+
+    Rounds and matches are recorded with the IDs of both players, so the history of a player
+    is the union of the results where it played either sign. Players without an ID are None.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        batch_size: int = RESULTS_BATCH_SIZE,
+        flush_interval: float = RESULTS_FLUSH_INTERVAL,
+        max_pending: int = RESULTS_MAX_PENDING,
+    ):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+
+        # Results waiting to be written, as rows of their tables.
+        self.rounds = []
+        self.matches = []
+
+        # The connection is opened and used by the single thread of the executor.
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix="results")
+        self.connection = None
+
+        # Task that writes the waiting results, and event that wakes it up once a batch is full.
+        self.writer_task = None
+        self.batch_full = None
+
+        # Number of results written and dropped, and of batches they were written in.
+        self.stats = {
+            "rounds": 0,
+            "matches": 0,
+            "batches": 0,
+            "dropped": 0,
+        }
+
+    async def run(self, function, *args):
+        """This function runs the function in the database thread and waits for its result."""
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, function, *args
+        )
+
+    async def start(self):
+        """This function opens the database and starts the writer task."""
+        await self.run(self.open)
+
+        self.batch_full = asyncio.Event()
+        self.writer_task = asyncio.create_task(self.write())
+
+    def open(self):
+        """This function opens the database and creates its tables if needed."""
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+
+        # Batches are committed without waiting for the disk on every transaction.
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+
+    async def close(self):
+        """This function writes the waiting results and closes the database."""
+        if self.writer_task is not None:
+            # The writer stops once it has written the waiting results.
+            writer_task, self.writer_task = self.writer_task, None
+            self.batch_full.set()
+            await writer_task
+
+        if self.connection is not None:
+            await self.run(self.connection.close)
+            self.connection = None
+        self.executor.shutdown()
+
+    def add(self, rows: list, row: tuple):
+        """This function queues the row to be written, waking up the writer once a batch is full."""
+        if len(self.rounds) + len(self.matches) >= self.max_pending:
+            self.stats["dropped"] += 1
+            return
+
+        rows.append(row)
+        if self.batch_full is not None and len(rows) >= self.batch_size:
+            self.batch_full.set()
+
+    def record_round(
+        self,
+        room_id: int,
+        round: int,
+        player_x: str | None,
+        player_o: str | None,
+        winner: str | None,
+    ):
+        """Records the finished round. The winner is None if the round was a draw."""
+        self.add(self.rounds, (room_id, round, player_x, player_o, winner, time()))
+
+    def record_match(
+        self,
+        room_id: int,
+        player_x: str | None,
+        player_o: str | None,
+        x_wins: int,
+        o_wins: int,
+        rounds: int,
+        started_at: float,
+    ):
+        """Records the match, which ends when either player leaves the room."""
+        self.add(
+            self.matches,
+            (room_id, player_x, player_o, x_wins, o_wins, rounds, started_at, time()),
+        )
+
+    async def write(self):
+        """This function writes the waiting results whenever a batch is full or the flush interval has passed."""
+        while True:
+            try:
+                await asyncio.wait_for(self.batch_full.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+
+            self.batch_full.clear()
+            try:
+                await self.flush()
+            except sqlite3.Error:
+                logger.exception("Could not write the results")
+
+            if self.writer_task is None:
+                return
+
+    async def flush(self):
+        """This function writes all waiting results in a single transaction."""
+        rounds, matches = self.rounds, self.matches
+        if not rounds and not matches:
+            return
+
+        self.rounds, self.matches = [], []
+        await self.run(self.insert, rounds, matches)
+
+        self.stats["rounds"] += len(rounds)
+        self.stats["matches"] += len(matches)
+        self.stats["batches"] += 1
+
+    def insert(self, rounds: list[tuple], matches: list[tuple]):
+        """This function inserts the rows in the database thread."""
+        with self.connection:
+            self.connection.executemany(
+                "INSERT INTO rounds (room_id, round, player_x, player_o, winner, finished_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                rounds,
+            )
+            self.connection.executemany(
+                "INSERT INTO matches (room_id, player_x, player_o, x_wins, o_wins, rounds, started_at, finished_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                matches,
+            )
+
+    async def get_history(self, player: str, limit: int = HISTORY_LIMIT) -> dict:
+        """Gets the last matches and rounds of the player, newest first, and its totals over all rounds."""
+        return await self.run(self.query_history, player, limit)
+
+    def query_history(self, player: str, limit: int) -> dict:
+        """This function queries the history of the player in the database thread."""
+        parameters = {"player": player, "limit": limit}
+
+        # Players are looked up by either sign, without counting the games against themselves twice.
+        match_rows = self.connection.execute(
+            "SELECT room_id, player_x, player_o, x_wins, o_wins, rounds, started_at, finished_at FROM ("
+            " SELECT * FROM matches WHERE player_x = :player"
+            " UNION ALL SELECT * FROM matches WHERE player_o = :player AND player_x IS NOT :player"
+            ") ORDER BY finished_at DESC LIMIT :limit",
+            parameters,
+        )
+        matches = [
+            {
+                "room_id": room_id,
+                "sign": "x" if player_x == player else "o",
+                "opponent": player_o if player_x == player else player_x,
+                "x_wins": x_wins,
+                "o_wins": o_wins,
+                "rounds": rounds,
+                "started_at": started_at,
+                "finished_at": finished_at,
+            }
+            for room_id, player_x, player_o, x_wins, o_wins, rounds, started_at, finished_at in match_rows
+        ]
+
+        round_rows = self.connection.execute(
+            "SELECT room_id, round, player_x, player_o, winner, finished_at FROM ("
+            " SELECT * FROM rounds WHERE player_x = :player"
+            " UNION ALL SELECT * FROM rounds WHERE player_o = :player AND player_x IS NOT :player"
+            ") ORDER BY finished_at DESC LIMIT :limit",
+            parameters,
+        )
+        rounds = [
+            {
+                "room_id": room_id,
+                "round": round,
+                "sign": "x" if player_x == player else "o",
+                "opponent": player_o if player_x == player else player_x,
+                "winner": winner,
+                "finished_at": finished_at,
+            }
+            for room_id, round, player_x, player_o, winner, finished_at in round_rows
+        ]
+
+        wins, losses, draws = self.connection.execute(
+            "SELECT"
+            " COUNT(CASE WHEN winner = sign THEN 1 END),"
+            " COUNT(CASE WHEN winner != sign THEN 1 END),"
+            " COUNT(CASE WHEN winner IS NULL THEN 1 END)"
+            " FROM ("
+            " SELECT winner, 'x' AS sign FROM rounds WHERE player_x = :player"
+            " UNION ALL SELECT winner, 'o' AS sign FROM rounds WHERE player_o = :player AND player_x IS NOT :player"
+            ")",
+            parameters,
+        ).fetchone()
+
+        return {
+            "player": player,
+            "wins": wins,
+            "losses": losses,
+            "draws": draws,
+            "matches": matches,
+            "rounds": rounds,
+        }
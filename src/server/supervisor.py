@@ -0,0 +1,112 @@
+"""
+Supervisor that runs the server as several shard processes on one host.
+
+Every shard is a separate uvicorn process listening on its own port, starting from the given one.
+Rooms are owned by the shard that created them, and players joining a room of another shard are
+redirected to it, so every game runs in a single process. Shards that exit are restarted.
+
+Run it from the `src/` directory:
+
+    python -m server.supervisor --shards 4 --host localhost --port 8000
+"""
+
+import argparse
+import logging
+import os
+import secrets
+import signal
+import subprocess
+import sys
+import threading
+
+logger = logging.getLogger("server.supervisor")
+
+# Time in seconds between checks of the shard processes.
+POLL_INTERVAL = 1.0
+
+# Set when the supervisor receives SIGTERM.
+stopping = threading.Event()
+
+
+def start_shard(
+    index: int, host: str, port: int, shard_urls: list[str], token: str
+) -> subprocess.Popen:
+    """This function starts the shard process with the given index."""
+    env = dict(
+        os.environ,
+        SHARD_INDEX=str(index),
+        SHARD_URLS=",".join(shard_urls),
+        SHARD_TOKEN=token,
+    )
+    command = [
+        sys.executable,
+        "-m",
+        "uvicorn",
+        "server.main:app",
+        "--host",
+        host,
+        "--port",
+        str(port),
+    ]
+    logger.info("Starting shard %d on %s:%d", index, host, port)
+    return subprocess.Popen(command, env=env)
+
+
+def stop(signum, frame):
+    """This function stops the supervisor when it receives SIGTERM."""
+    stopping.set()
+
+
+def main():
+    """This function starts the shards and restarts them if they exit, until it is interrupted."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--shards", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--public-host",
+        help="Host to which clients are redirected, if it differs from --host.",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s"
+    )
+    signal.signal(signal.SIGTERM, stop)
+
+    public_host = args.public_host or args.host
+    ports = [args.port + index for index in range(args.shards)]
+    shard_urls = [f"{public_host}:{port}" for port in ports]
+
+    # Secret that the shards send when they link to each other, generated unless it is set.
+    token = os.environ.get("SHARD_TOKEN") or secrets.token_urlsafe()
+
+    processes = [
+        start_shard(index, args.host, port, shard_urls, token)
+        for index, port in enumerate(ports)
+    ]
+
+    try:
+        while not stopping.wait(POLL_INTERVAL):
+            for index, process in enumerate(processes):
+                if process.poll() is not None:
+                    logger.warning(
+                        "Shard %d exited with code %d, restarting",
+                        index,
+                        process.returncode,
+                    )
+                    processes[index] = start_shard(
+                        index, args.host, ports[index], shard_urls, token
+                    )
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logger.info("Stopping %d shards", len(processes))
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+
+if __name__ == "__main__":
+    main()
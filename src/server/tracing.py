@@ -0,0 +1,85 @@
+"""
+This file contains the tracer of the server, which records how long the handling of messages takes.
+
+A sample of the messages is traced: their decoding, the handler, the game events they cause,
+the lobby updates and the encoding and sending of the messages to the clients.
+The spans are kept in a ring buffer and can be dumped in the Chrome trace-event format,
+to be opened in `chrome://tracing` or https://ui.perfetto.dev.
+"""
+
+import os
+from collections import deque
+from random import random
+
+# Number of spans kept in the ring buffer.
+TRACE_BUFFER_SIZE = 10000
+
+# Rows of the trace, shown as threads.
+RECEIVE_TID = 1
+GAME_TID = 2
+LOBBY_TID = 3
+SEND_TID = 4
+THREAD_NAMES = {
+    RECEIVE_TID: "receive",
+    GAME_TID: "game",
+    LOBBY_TID: "lobby",
+    SEND_TID: "send",
+}
+
+
+class Tracer:
+    """This class records the sampled spans in a ring buffer."""
+
+    def __init__(self, sample_rate: float = 0.0, capacity: int = TRACE_BUFFER_SIZE):
+        self.configure(sample_rate, capacity)
+
+    def configure(self, sample_rate: float, capacity: int = TRACE_BUFFER_SIZE):
+        """Sets the fraction of the messages that are traced and the size of the buffer, dropping all spans."""
+        self.sample_rate = sample_rate
+        self.spans = deque(maxlen=capacity)
+
+    def sampled(self) -> bool:
+        """Decides if the next message is traced."""
+        return self.sample_rate > 0 and (
+            self.sample_rate >= 1 or random() < self.sample_rate
+        )
+
+    def record(
+        self, name: str, tid: int, start: float, end: float, args: dict | None = None
+    ):
+        """Records the span between the two `perf_counter` times."""
+        self.spans.append((name, tid, start, end, args))
+
+    def dump(self) -> dict:
+        """Gets the recorded spans in the Chrome trace-event format."""
+        pid = os.getpid()
+
+        events = [
+            {
+                "name": "thread_name",
+                "ph": "M",
+                "pid": pid,
+                "tid": tid,
+                "args": {"name": name},
+            }
+            for tid, name in THREAD_NAMES.items()
+        ]
+        for name, tid, start, end, args in self.spans:
+            event = {
+                "name": name,
+                "cat": THREAD_NAMES[tid],
+                "ph": "X",
+                "pid": pid,
+                "tid": tid,
+                "ts": round(start * 1e6, 3),
+                "dur": round((end - start) * 1e6, 3),
+            }
+            if args:
+                event["args"] = args
+            events.append(event)
+
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+# Tracer shared by the whole server, configured when it starts.
+tracer = Tracer()
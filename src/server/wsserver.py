@@ -1,8 +1,10 @@
 """Entry point for the server application."""
 
+import json
 import re
 from asyncio import gather
 from enum import Enum
+from functools import cached_property
 from typing import List
 from uuid import uuid4
 
@@ -31,6 +33,11 @@ class Message:
         """Gets the message instance serialised as a dictionary."""
         return {"type": self.type, **self.options}
 
+    @cached_property
+    def encoded(self) -> str:
+        """Gets the message encoded as JSON, which is only done once for all clients it is sent to."""
+        return json.dumps(self.serialised, ensure_ascii=False, separators=(",", ":"))
+
 
 class Client:
     """The main class for the client.
@@ -76,7 +83,7 @@ class Client:
         Args:
             message: The Message object to send.
         """
-        await self.socket.send_json(message.serialised)
+        await self.socket.send_text(message.encoded)
 
     async def accept(self) -> None:
         """Accepts the socket connection"""
@@ -0,0 +1,250 @@
+"""
+Tests of the Redis registry against a local stand-in for Redis.
+
+The stand-in is the TCP server of `fakeredis`, so the tests need neither a Redis server nor the network.
+Run them from the `src/` directory with `python -m pytest tests`.
+"""
+
+import asyncio
+import json
+import threading
+
+import pytest
+
+from server import registry as registry_module
+from server.connectionManager import ConnectionManager
+from server.gameManager import GameManager
+from server.registry import RedisRegistry
+
+fakeredis = pytest.importorskip("fakeredis")
+
+
+class FakeWebSocket:
+    """Websocket that keeps the messages sent to it."""
+
+    def __init__(self):
+        self.query_params = {}
+        self.scope = {}
+        self.sent = []
+
+    async def accept(self, subprotocol: str | None = None):
+        """Accepts the connection."""
+
+    async def send_text(self, data: str):
+        """Keeps the sent message."""
+        self.sent.append(json.loads(data))
+
+    async def close(self, code: int = 1000):
+        """Closes the connection."""
+
+    def types(self) -> list[str]:
+        """Gets the types of the sent messages."""
+        return [message["type"] for message in self.sent]
+
+
+@pytest.fixture(scope="module")
+def redis_url():
+    """Starts the stand-in for Redis and returns its URL."""
+    server = fakeredis.TcpFakeServer(("127.0.0.1", 0), server_type="redis")
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    host, port = server.server_address
+    yield f"redis://{host}:{port}/0"
+
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def prefix(request) -> str:
+    """Gets a key prefix of its own for every test, as they share the stand-in."""
+    return f"test:{request.node.name}:"
+
+
+async def settle():
+    """Waits for the published messages to be delivered and the lobby to be flushed."""
+    await asyncio.sleep(0.1)
+
+
+def test_rooms(redis_url, prefix):
+    """Rooms are created, joined and left, and the open rooms follow them."""
+
+    async def run():
+        registry = RedisRegistry(redis_url, prefix)
+        await registry.connect()
+
+        assert await registry.create_room(1, "worker", "worker/1")
+        assert not await registry.create_room(1, "worker", "worker/2")
+        assert await registry.get_open_rooms() == [1]
+
+        assert await registry.join_room(1, "worker/2") == (
+            "o",
+            {"x": "worker/1", "o": "worker/2", "owner": "worker", "created": b"1"},
+        )
+        assert await registry.join_room(1, "worker/3") == (None, await registry.get_room(1))
+        assert await registry.join_room(2, "worker/3") == (None, None)
+        assert await registry.count_rooms() == {"open": 0, "full": 1}
+
+        room = await registry.leave_room(1, "x")
+        assert room["x"] is None and room["o"] == "worker/2"
+        assert await registry.get_open_rooms() == [1]
+
+        assert await registry.leave_room(1, "o") is None
+        assert await registry.get_room(1) is None
+        assert await registry.count_rooms() == {"open": 0, "full": 0}
+
+        await registry.close()
+
+    asyncio.run(run())
+
+
+def test_create_room_takes_x_seat(redis_url, prefix):
+    """A player joining a room while it is created never takes the seat of its creator."""
+
+    async def run():
+        registry = RedisRegistry(redis_url, prefix)
+        await registry.connect()
+
+        for room_id in range(20):
+            _, (sign, _) = await asyncio.gather(
+                registry.create_room(room_id, "worker", "worker/x"),
+                registry.join_room(room_id, "worker/o"),
+            )
+            assert sign in ("o", None)
+
+            room = await registry.get_room(room_id)
+            assert room["x"] == "worker/x"
+            assert room["o"] == ("worker/o" if sign == "o" else None)
+
+        await registry.close()
+
+    asyncio.run(run())
+
+
+def test_game_across_workers(redis_url, prefix):
+    """Players connected to different workers play in the same room."""
+
+    async def run():
+        workers = []
+        for _ in range(2):
+            conn_manager = ConnectionManager(
+                lobby_flush_interval=0.01,
+                registry=RedisRegistry(redis_url, prefix),
+                heartbeat_interval=0,
+            )
+            game_manager = GameManager(conn_manager)
+            conn_manager.game_event_handler = game_manager.post
+            await conn_manager.start()
+            workers.append(conn_manager)
+
+        first, second = workers
+        player_x, player_o, lobby = FakeWebSocket(), FakeWebSocket(), FakeWebSocket()
+        await first.connect(player_x)
+        await second.connect(player_o)
+        await second.connect(lobby)
+
+        await first.create_room(player_x)
+        room_id = first.client_rooms[player_x][0]
+        await settle()
+        assert lobby.sent[-1]["rooms_added"] == [room_id]
+
+        x, o = await second.join_room(player_o, room_id)
+        second.relay_game_event(
+            player_o,
+            {"type": "start_game", "room_id": room_id, "player_x": x, "player_o": o},
+        )
+        await settle()
+        assert lobby.sent[-1]["rooms_removed"] == [room_id]
+
+        second.relay_game_event(
+            player_o, {"type": "move", "room_id": room_id, "sign": "o", "cell": 4}
+        )
+        await settle()
+        for client in (player_x, player_o):
+            assert "start_countdown" in client.types()
+            assert client.sent[-1] == {"type": "cell_set", "cell": 4, "sign": "o", "seq": 1}
+
+        for conn_manager in workers:
+            await conn_manager.stop()
+
+    asyncio.run(run())
+
+
+def test_lost_connection(redis_url, prefix, monkeypatch):
+    """Commands fail right away while the connection is lost, and work again once it is reopened."""
+    monkeypatch.setattr(registry_module, "REDIS_RECONNECT_DELAY", 0.05)
+
+    async def run():
+        registry = RedisRegistry(redis_url, prefix)
+        await registry.connect()
+
+        received = []
+
+        def handler(message: dict):
+            if message.get("fail"):
+                raise ValueError("Handler failed")
+            received.append(message)
+
+        # Errors of the handlers do not stop the delivery of the next messages.
+        await registry.subscribe("channel", handler)
+        registry.publish("channel", {"fail": True})
+        registry.publish("channel", {"number": 1})
+        await settle()
+        assert received == [{"number": 1}]
+
+        registry.commands.writer.transport.abort()
+        registry.subscriber.writer.transport.abort()
+        await asyncio.sleep(0)
+        with pytest.raises(ConnectionError):
+            await asyncio.wait_for(registry.create_room(1, "worker", "worker/1"), 1)
+
+        await settle()
+        assert await registry.create_room(1, "worker", "worker/1")
+        registry.publish("channel", {"number": 2})
+        await settle()
+        assert received == [{"number": 1}, {"number": 2}]
+
+        await registry.close()
+
+    asyncio.run(run())
+
+
+def test_lobby_resync(redis_url, prefix, monkeypatch):
+    """Changes to the open rooms missed while the connection was lost are sent once it is reopened."""
+    monkeypatch.setattr(registry_module, "REDIS_RECONNECT_DELAY", 0.05)
+
+    async def run():
+        other = RedisRegistry(redis_url, prefix)
+        await other.connect()
+        await other.create_room(1, "other", "other/1")
+
+        conn_manager = ConnectionManager(
+            lobby_flush_interval=0.01,
+            registry=RedisRegistry(redis_url, prefix),
+            heartbeat_interval=0,
+        )
+        await conn_manager.start()
+        lobby = FakeWebSocket()
+        await conn_manager.connect(lobby)
+        assert list(conn_manager.open_rooms) == [1]
+
+        # The changes are not published, as if their messages were lost.
+        conn_manager.registry.subscriber.writer.transport.abort()
+        await other.create_room(2, "other", "other/2")
+        await other.leave_room(1, "x")
+
+        # Waits for the connection to be reopened, which can take a while on a busy machine.
+        for _ in range(50):
+            if list(conn_manager.open_rooms) == [2]:
+                break
+            await asyncio.sleep(0.05)
+        await settle()
+        assert list(conn_manager.open_rooms) == [2]
+        assert lobby.sent[-1]["rooms_added"] == [2]
+        assert lobby.sent[-1]["rooms_removed"] == [1]
+
+        await conn_manager.stop()
+        await other.close()
+
+    asyncio.run(run())
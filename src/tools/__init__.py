@@ -0,0 +1 @@
+"""Package containing the development tools of the server, such as the load generator."""
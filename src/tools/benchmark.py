@@ -0,0 +1,401 @@
+"""
+Micro-benchmarks of the hot paths of the game and connection managers.
+
+The managers are filled with fake websockets for every size (number of rooms with a game
+in progress). A tenth of that many rooms are open with one waiting player, and as many
+clients are in the lobby. Every benchmark is timed in batches, and the time per operation
+is reported as the median and minimum over the batches.
+
+Run it from the `src/` directory and compare the results of two commits:
+
+    python -m tools.benchmark run --output before.json
+    python -m tools.benchmark run --output after.json
+    python -m tools.benchmark compare before.json after.json --threshold 0.1
+
+The comparison exits with status 1 if any benchmark got slower by more than the threshold.
+"""
+
+import argparse
+import asyncio
+import json
+import platform
+import subprocess
+import sys
+import time
+from statistics import median
+
+from server.connectionManager import ConnectionManager
+from server.gameManager import GameManager
+
+# Numbers of rooms with a game in progress that the benchmarks are run with.
+SIZES = (10, 100, 1000, 10000, 100000)
+
+# Minimum number of batches and minimum total time in seconds of every benchmark.
+MIN_BATCHES = 5
+MIN_TIME = 0.2
+
+# Maximum number of rooms used by a single batch, so that no outbox fills up.
+BATCH_ROOMS = 1000
+
+# Number of lobby updates in a single batch. Each one sends a message to every lobby client.
+LOBBY_BATCH = 20
+
+# Cells and signs of the moves played in every room, which end in a win of "x" on the diagonal.
+MOVES = tuple(zip((0, 1, 2, 3, 4, 5, 6), "xoxoxox"))
+
+
+class FakeWebSocket:
+    """Websocket that accepts everything sent to it without doing any I/O."""
+
+    def __init__(self):
+        self.query_params = {}
+        self.scope = {}
+        self.sent = 0
+
+    async def accept(self, subprotocol: str | None = None):
+        """Accepts the connection."""
+
+    async def send_text(self, data: str):
+        """Counts the sent message."""
+        self.sent += 1
+
+    async def send_bytes(self, data: bytes):
+        """Counts the sent message."""
+        self.sent += 1
+
+    async def close(self, code: int = 1000):
+        """Closes the connection."""
+
+
+class Environment:
+    """Managers filled with the rooms and clients of the given size."""
+
+    def __init__(self, size: int):
+        self.size = size
+
+        # The lobby is only flushed by the benchmarks themselves.
+        self.conn_manager = ConnectionManager(
+            lobby_flush_interval=3600, heartbeat_interval=0
+        )
+        self.game_manager = GameManager(self.conn_manager)
+        self.conn_manager.game_event_handler = self.game_manager.post
+
+        # Room ID and connections of the players of every room with a game in progress,
+        # and the index of every room ID in that list.
+        self.rooms = []
+        self.rooms_index = {}
+
+        # IDs of the open rooms and number of moves played in every full room.
+        self.open_room_ids = []
+        self.moves_played = [0] * size
+        self.offset = 0
+
+    async def connect(self, in_lobby: bool = False) -> FakeWebSocket:
+        """Connects a fake client."""
+        client = FakeWebSocket()
+        await self.conn_manager.connect(client)
+        if not in_lobby:
+            self.conn_manager.leave_lobby(client)
+        return client
+
+    async def fill(self):
+        """Creates the rooms and clients."""
+        conn_manager = self.conn_manager
+        await conn_manager.start()
+
+        for _ in range(self.size):
+            player_x, player_o = await self.connect(), await self.connect()
+            await conn_manager.create_room(player_x)
+            room_id = conn_manager.client_rooms[player_x][0]
+            await conn_manager.join_room(player_o, room_id)
+
+            self.game_manager.start_game(
+                room_id,
+                conn_manager.conn_ids[player_x],
+                conn_manager.conn_ids[player_o],
+            )
+            self.rooms_index[room_id] = len(self.rooms)
+            self.rooms.append((room_id, player_x, player_o))
+
+        for _ in range(max(self.size // 10, 1)):
+            player = await self.connect()
+            await conn_manager.create_room(player)
+            self.open_room_ids.append(conn_manager.client_rooms[player][0])
+
+            await self.connect(in_lobby=True)
+
+        await self.settle()
+
+    async def settle(self):
+        """Sends all pending lobby changes and waits until every queued message is sent."""
+        await self.conn_manager.update_open_rooms()
+
+        outboxes = self.conn_manager.outboxes.values()
+        pending = [outbox for outbox in outboxes if not outbox.queue.empty()]
+        while pending:
+            await asyncio.sleep(0)
+            pending = [outbox for outbox in pending if not outbox.queue.empty()]
+
+    def next_rooms(self) -> list[tuple]:
+        """Gets the rooms for the next batch, going through all rooms in turn."""
+        count = min(self.size, BATCH_ROOMS)
+        rooms = [
+            self.rooms[(self.offset + index) % self.size] for index in range(count)
+        ]
+        self.offset = (self.offset + count) % self.size
+        return rooms
+
+    async def close(self):
+        """Stops the writer tasks of all clients."""
+        for outbox in self.conn_manager.outboxes.values():
+            outbox.close()
+        self.game_manager.stop()
+        await self.conn_manager.stop()
+        await asyncio.sleep(0)
+
+
+async def bench_move(env: Environment) -> tuple[int, float]:
+    """GameManager.move, including sending the updates to the players' outboxes."""
+    game_manager = env.game_manager
+    batch = []
+    for room_id, _, _ in env.next_rooms():
+        index = env.rooms_index[room_id]
+        cell, sign = MOVES[env.moves_played[index] % len(MOVES)]
+        env.moves_played[index] += 1
+        batch.append((room_id, sign, cell))
+
+    started = time.perf_counter()
+    for room_id, sign, cell in batch:
+        game_manager.move(room_id, sign, cell)
+    elapsed = time.perf_counter() - started
+
+    await env.settle()
+    return len(batch), elapsed
+
+
+async def bench_check_win_round(env: Environment) -> tuple[int, float]:
+    """GameManager.check_win_round on the current boards."""
+    game_manager = env.game_manager
+    games = [game_manager.games[room_id] for room_id, _, _ in env.next_rooms()]
+
+    started = time.perf_counter()
+    for game in games:
+        game_manager.check_win_round(game, "x")
+    return len(games), time.perf_counter() - started
+
+
+async def bench_check_draw_round(env: Environment) -> tuple[int, float]:
+    """GameManager.check_draw_round on the current boards."""
+    game_manager = env.game_manager
+    games = [game_manager.games[room_id] for room_id, _, _ in env.next_rooms()]
+
+    started = time.perf_counter()
+    for game in games:
+        game_manager.check_draw_round(game)
+    return len(games), time.perf_counter() - started
+
+
+async def bench_get_open_rooms(env: Environment) -> tuple[int, float]:
+    """ConnectionManager.get_open_rooms with a tenth of the size open."""
+    conn_manager = env.conn_manager
+    count = 100
+
+    started = time.perf_counter()
+    for _ in range(count):
+        await conn_manager.get_open_rooms()
+    return count, time.perf_counter() - started
+
+
+async def bench_remove_client_from_room(env: Environment) -> tuple[int, float]:
+    """ConnectionManager.remove_client_from_room of the "o" player, who then joins the room again untimed."""
+    conn_manager = env.conn_manager
+    rooms = env.next_rooms()
+
+    started = time.perf_counter()
+    for _, _, player_o in rooms:
+        await conn_manager.remove_client_from_room(player_o)
+    elapsed = time.perf_counter() - started
+
+    for room_id, _, player_o in rooms:
+        await conn_manager.join_room(player_o, room_id)
+    await env.settle()
+    return len(rooms), elapsed
+
+
+async def bench_update_open_rooms(env: Environment) -> tuple[int, float]:
+    """ConnectionManager.update_open_rooms with one changed room, sent to a tenth of the size of lobby clients."""
+    conn_manager = env.conn_manager
+    room_id = env.open_room_ids[0]
+
+    started = time.perf_counter()
+    for index in range(LOBBY_BATCH):
+        if index % 2:
+            conn_manager.open_room(room_id)
+        else:
+            conn_manager.close_room(room_id)
+        await conn_manager.update_open_rooms()
+    elapsed = time.perf_counter() - started
+
+    await env.settle()
+    return LOBBY_BATCH, elapsed
+
+
+BENCHMARKS = {
+    "GameManager.move": bench_move,
+    "GameManager.check_win_round": bench_check_win_round,
+    "GameManager.check_draw_round": bench_check_draw_round,
+    "ConnectionManager.get_open_rooms": bench_get_open_rooms,
+    "ConnectionManager.remove_client_from_room": bench_remove_client_from_room,
+    "ConnectionManager.update_open_rooms": bench_update_open_rooms,
+}
+
+
+async def run_benchmark(env: Environment, benchmark) -> dict:
+    """Runs the benchmark in batches and gets its time per operation in microseconds."""
+    per_operation = []
+    total = 0.0
+
+    while len(per_operation) < MIN_BATCHES or total < MIN_TIME:
+        operations, elapsed = await benchmark(env)
+        per_operation.append(elapsed / operations * 1e6)
+        total += elapsed
+
+    return {
+        "median_us": round(median(per_operation), 4),
+        "min_us": round(min(per_operation), 4),
+        "batches": len(per_operation),
+    }
+
+
+async def run_size(size: int, names: list[str]) -> dict:
+    """Runs the benchmarks with the given number of rooms."""
+    env = Environment(size)
+    await env.fill()
+
+    results = {}
+    try:
+        for name in names:
+            result = await run_benchmark(env, BENCHMARKS[name])
+            results[f"{name}[{size}]"] = {"rooms": size, **result}
+            print(f"{name}[{size}]: {result['median_us']} us", file=sys.stderr)
+    finally:
+        await env.close()
+
+    return results
+
+
+def get_commit() -> str | None:
+    """Gets the commit that is checked out, if the code is in a git repository."""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args: argparse.Namespace):
+    """Runs the benchmarks and writes their results as JSON."""
+    names = [
+        name
+        for name in BENCHMARKS
+        if not args.only or any(part in name for part in args.only)
+    ]
+
+    results = {}
+    for size in args.sizes:
+        results.update(asyncio.run(run_size(size, names)))
+
+    report = {
+        "commit": get_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": results,
+    }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+    else:
+        print(output)
+
+
+def compare(args: argparse.Namespace) -> int:
+    """Prints the change of every benchmark between the two results and returns 1 if any of them regressed."""
+    with open(args.base) as file:
+        base = json.load(file)
+    with open(args.new) as file:
+        new = json.load(file)
+
+    print(f"{'benchmark':<52} {'base us':>10} {'new us':>10} {'change':>8}")
+
+    regressions = 0
+    for name, result in new["results"].items():
+        if name not in base["results"]:
+            continue
+
+        before, after = base["results"][name][args.metric], result[args.metric]
+        change = after / before - 1 if before else 0.0
+        flag = ""
+        if change > args.threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        print(f"{name:<52} {before:>10.3f} {after:>10.3f} {change:>+8.1%}{flag}")
+
+    print(
+        f"{regressions} regressions beyond {args.threshold:.0%} ({base['commit']} -> {new['commit']})"
+    )
+    return 1 if regressions else 0
+
+
+def main():
+    """This function parses the command line and runs the chosen mode."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    modes = parser.add_subparsers(dest="mode", required=True)
+
+    run_parser = modes.add_parser("run", help="Run the benchmarks.")
+    run_parser.add_argument(
+        "--sizes",
+        type=lambda sizes: [int(size) for size in sizes.split(",")],
+        default=list(SIZES),
+        help="Comma-separated numbers of rooms.",
+    )
+    run_parser.add_argument(
+        "--only",
+        nargs="*",
+        help="Run only the benchmarks whose names contain one of these.",
+    )
+    run_parser.add_argument(
+        "--output", help="File to write the results to, instead of stdout."
+    )
+
+    compare_parser = modes.add_parser("compare", help="Compare two results.")
+    compare_parser.add_argument("base")
+    compare_parser.add_argument("new")
+    compare_parser.add_argument(
+        "--metric",
+        choices=("median_us", "min_us"),
+        default="median_us",
+        help="Time per operation that is compared. The minimum is less affected by noise.",
+    )
+    compare_parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="Relative slowdown that counts as a regression.",
+    )
+
+    args = parser.parse_args()
+    if args.mode == "run":
+        run(args)
+    else:
+        sys.exit(compare(args))
+
+
+if __name__ == "__main__":
+    main()
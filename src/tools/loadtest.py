@@ -0,0 +1,358 @@
+"""
+Load generator that plays games against a local server with headless bot clients.
+
+Every game is played by two bots: one creates a room and the other joins it. Both then keep
+moving to free cells until the given number of rounds is played, and leave the room.
+The latency of a move is the time from sending it to receiving the server's update
+of that cell (`cell_set`, which is followed by `win_round` if the move won the round).
+The games are spread over a pool of processes, each running its bots in one event loop.
+
+Run it from the `src/` directory, against a server on the same host:
+
+    uvicorn server.main:app --host 127.0.0.1 --port 8000
+    python -m tools.loadtest --processes 4 --games 250 --rounds 3
+
+Or let it start the server itself with `--spawn-server`.
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from statistics import quantiles
+from urllib.parse import urlsplit
+
+import websockets
+
+# Hosts that the load generator is allowed to connect to.
+LOOPBACK_HOSTS = ("localhost", "127.0.0.1", "::1")
+
+# Order in which the bots of each sign take the free cells in scripted games.
+SCRIPTS = {
+    "x": (0, 1, 2, 3, 4, 5, 6, 7, 8),
+    "o": (8, 7, 6, 5, 4, 3, 2, 1, 0),
+}
+
+# Time in seconds that a bot waits for the reply to its move before giving up on it.
+MOVE_TIMEOUT = 5.0
+
+
+class Bot:
+    """Headless client that plays a single game."""
+
+    def __init__(self, url: str, mode: str, rounds: int, think_time: float):
+        self.url = url
+        self.mode = mode
+        self.rounds = rounds
+        self.think_time = think_time
+
+        self.room_id = None
+        self.sign = None
+        self.board = [None] * 9
+        self.round = 0
+
+        # Cell of the move waiting for its reply, and the time it was sent.
+        self.pending = None
+        self.sent_at = 0.0
+        self.replied = asyncio.Event()
+
+        self.latencies = []
+        self.rejected = 0
+        self.timed_out = 0
+        self.rate_limited = 0
+
+    async def send(self, message: dict):
+        """Sends the message to the server."""
+        await self.websocket.send(json.dumps(message))
+
+    async def receive(self) -> dict:
+        """Waits for the next message from the server."""
+        return json.loads(await self.websocket.recv())
+
+    async def expect(self, message_type: str) -> dict:
+        """Waits for the next message of the given type, skipping all others (e.g. lobby updates)."""
+        while True:
+            message = await self.receive()
+            if message["type"] == message_type:
+                return message
+            if message["type"] == "join_room_error":
+                raise RuntimeError(message["message"])
+
+    async def host(self, room: asyncio.Future):
+        """Creates a room, passes its ID to the other bot and plays the game."""
+        async with websockets.connect(self.url) as self.websocket:
+            await self.send({"type": "create_room"})
+            created = await self.expect("create_room")
+            self.room_id, self.sign = created["room_id"], created["sign"]
+            room.set_result(self.room_id)
+            await self.play()
+
+    async def join(self, room: asyncio.Future):
+        """Joins the room created by the other bot and plays the game."""
+        room_id = await room
+        async with websockets.connect(self.url) as self.websocket:
+            await self.send({"type": "join_room", "room_id": room_id})
+            joined = await self.expect("join_room")
+            self.room_id, self.sign = joined["room_id"], joined["sign"]
+            await self.play()
+
+    async def play(self):
+        """Moves until all rounds are played, while handling the server's messages in the background."""
+        listener = asyncio.create_task(self.listen())
+        try:
+            while True:
+                await asyncio.sleep(self.think_time)
+                if self.round > self.rounds or listener.done():
+                    break
+
+                cell = self.choose_cell()
+                if self.round == 0 or cell is None:
+                    continue
+
+                self.pending, self.sent_at = cell, time.perf_counter()
+                self.replied.clear()
+                await self.send(
+                    {
+                        "type": "move",
+                        "room_id": self.room_id,
+                        "sign": self.sign,
+                        "cell": cell,
+                    }
+                )
+                try:
+                    await asyncio.wait_for(self.replied.wait(), MOVE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    self.timed_out += 1
+                    self.pending = None
+
+            await self.send({"type": "leave_room"})
+        finally:
+            listener.cancel()
+
+    def choose_cell(self) -> int | None:
+        """Chooses a free cell, randomly or in the order of the bot's script."""
+        free = [cell for cell in SCRIPTS[self.sign] if self.board[cell] is None]
+        if not free:
+            return None
+        if self.mode == "random":
+            return random.choice(free)
+        return free[0]
+
+    async def listen(self):
+        """Applies the server's messages to the board and resolves the pending move."""
+        while True:
+            message = await self.receive()
+
+            match message["type"]:  # noqa: E999
+                case "start_countdown":
+                    self.round = message["round"]
+
+                case "update_board":
+                    self.board = [
+                        cell if cell != "*" else None
+                        for row in message["board"]
+                        for cell in row
+                    ]
+                    self.resolve(None, None)
+
+                case "cell_set":
+                    self.board[message["cell"]] = message["sign"]
+                    self.resolve(message["cell"], message["sign"])
+
+                case "rate_limited":
+                    self.rate_limited += 1
+                    self.pending = None
+                    self.replied.set()
+
+                case "player_disconnected":
+                    self.pending = None
+                    self.replied.set()
+                    return
+
+    def resolve(self, cell: int | None, sign: str | None):
+        """
+        Resolves the pending move
+
+        Records the latency of the pending move if the update is its reply,
+        or drops it if it can no longer succeed.
+        """
+        if self.pending is None or (cell is not None and cell != self.pending):
+            return
+
+        if sign == self.sign:
+            self.latencies.append(time.perf_counter() - self.sent_at)
+        else:
+            # The other player took the cell first, or the board was reset.
+            self.rejected += 1
+
+        self.pending = None
+        self.replied.set()
+
+
+async def play_games(
+    url: str, games: int, mode: str, rounds: int, think_time: float, ramp: float
+) -> dict:
+    """Plays the games concurrently and returns the results of all their bots."""
+    bots = []
+    tasks = []
+
+    for game in range(games):
+        room = asyncio.get_running_loop().create_future()
+        host = Bot(url, mode, rounds, think_time)
+        guest = Bot(url, mode, rounds, think_time)
+        bots += [host, guest]
+        tasks += [
+            asyncio.create_task(host.host(room)),
+            asyncio.create_task(guest.join(room)),
+        ]
+
+        # Spread the connections over the ramp-up time.
+        await asyncio.sleep(ramp / games)
+
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    errors = [repr(result) for result in results if isinstance(result, Exception)]
+
+    return {
+        "latencies": [latency for bot in bots for latency in bot.latencies],
+        "rejected": sum(bot.rejected for bot in bots),
+        "timed_out": sum(bot.timed_out for bot in bots),
+        "rate_limited": sum(bot.rate_limited for bot in bots),
+        "games": games - len(errors) // 2,
+        "errors": errors[:10],
+    }
+
+
+def run_process(
+    url: str, games: int, mode: str, rounds: int, think_time: float, ramp: float
+) -> dict:
+    """This function is run in every process of the pool."""
+    return asyncio.run(play_games(url, games, mode, rounds, think_time, ramp))
+
+
+def percentile(points: list[float], percent: int) -> float:
+    """Gets the given percentile of the points, in milliseconds."""
+    if len(points) < 2:
+        return points[0] * 1000 if points else 0.0
+    return quantiles(points, n=100)[percent - 1] * 1000
+
+
+def spawn_server(url: str) -> subprocess.Popen:
+    """Starts a server process listening on the port of the URL and waits until it accepts connections."""
+    parts = urlsplit(url)
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "server.main:app",
+            "--host",
+            parts.hostname,
+            "--port",
+            str(parts.port),
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+    async def wait_until_up():
+        while True:
+            try:
+                async with websockets.connect(url):
+                    return
+            except OSError:
+                await asyncio.sleep(0.1)
+
+    asyncio.run(asyncio.wait_for(wait_until_up(), 10))
+    return process
+
+
+def main():
+    """This function runs the load test and prints its report."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--url", default="ws://127.0.0.1:8000/ws")
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument(
+        "--games", type=int, default=100, help="Concurrent games per process."
+    )
+    parser.add_argument(
+        "--rounds", type=int, default=3, help="Rounds played in every game."
+    )
+    parser.add_argument("--mode", choices=("random", "scripted"), default="random")
+    parser.add_argument(
+        "--think-time",
+        type=float,
+        default=0.05,
+        help="Seconds between the moves of a bot.",
+    )
+    parser.add_argument(
+        "--ramp",
+        type=float,
+        default=1.0,
+        help="Seconds over which each process connects its bots.",
+    )
+    parser.add_argument(
+        "--spawn-server",
+        action="store_true",
+        help="Start a server on the port of the URL.",
+    )
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON.")
+    args = parser.parse_args()
+
+    if urlsplit(args.url).hostname not in LOOPBACK_HOSTS:
+        parser.error(
+            "The load generator only connects to servers on the loopback interface."
+        )
+
+    server = spawn_server(args.url) if args.spawn_server else None
+    started = time.perf_counter()
+
+    try:
+        with ProcessPoolExecutor(args.processes) as pool:
+            futures = [
+                pool.submit(
+                    run_process,
+                    args.url,
+                    args.games,
+                    args.mode,
+                    args.rounds,
+                    args.think_time,
+                    args.ramp,
+                )
+                for _ in range(args.processes)
+            ]
+            results = [future.result() for future in futures]
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    duration = time.perf_counter() - started
+    latencies = [latency for result in results for latency in result["latencies"]]
+    report = {
+        "games": sum(result["games"] for result in results),
+        "moves": len(latencies),
+        "rejected_moves": sum(result["rejected"] for result in results),
+        "timed_out_moves": sum(result["timed_out"] for result in results),
+        "rate_limited_moves": sum(result["rate_limited"] for result in results),
+        "duration": round(duration, 3),
+        "moves_per_second": round(len(latencies) / duration, 1),
+        "p50_ms": round(percentile(latencies, 50), 3),
+        "p95_ms": round(percentile(latencies, 95), 3),
+        "p99_ms": round(percentile(latencies, 99), 3),
+        "errors": [error for result in results for error in result["errors"]][:10],
+    }
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    for key, value in report.items():
+        print(f"{key:>18}: {value}")
+
+
+if __name__ == "__main__":
+    main()